@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from main import SolutionCache, Solver, iter_puzzles
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class SolveTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise SolveTimeout('Timeout')
+
+
+def limit_memory(memory_limit):
+    # Runs in every worker; a puzzle that blows past the limit gets a
+    # MemoryError in its own worker instead of taking the machine down
+    if memory_limit and resource is not None:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Shared flags the pool's owner sets to stop a running puzzle early, one
+# per slot; installed in every worker by start_pool
+stop_flags = None
+
+
+def init_worker(memory_limit, flags):
+    global stop_flags
+    limit_memory(memory_limit)
+    stop_flags = flags
+
+
+def start_pool(workers, memory_limit=None, flags=None):
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(memory_limit, flags)
+    )
+
+
+# One connection per worker process, opened on first use
+caches = {}
+
+
+def open_cache(path):
+    if path not in caches:
+        caches[path] = SolutionCache(path)
+    return caches[path]
+
+
+def solve_puzzle(
+    index,
+    puzzle,
+    timeout,
+    engine,
+    max_solutions,
+    cache=None,
+    stop_slot=None
+):
+    # With a stop_slot, the search gives up (status stopped) at its next
+    # node once the owner sets that slot's stop flag
+    start = time.perf_counter()
+    result = None
+    status = None
+    error = None
+    should_stop = None
+    if stop_slot is not None:
+        should_stop = lambda: stop_flags[stop_slot]
+
+    if timeout:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if cache:
+            result = open_cache(cache).solve(
+                puzzle['rows'], puzzle['columns'], max_solutions,
+                engine=engine, should_stop=should_stop
+            )
+        else:
+            solver = Solver(
+                input_json=puzzle,
+                headless=True,
+                engine=engine,
+                should_stop=should_stop
+            )
+            result = solver.solve(max_solutions)
+        status = result.status
+    except SolveTimeout:
+        status = 'timeout'
+    except MemoryError:
+        status = 'error'
+        error = 'Out of memory'
+    except Exception as e:
+        status = 'error'
+        error = repr(e)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    output = {
+        'index': index,
+        'id': puzzle.get('id') if isinstance(puzzle, dict) else None,
+        'status': status,
+        'grid': result.grid if result is not None else None,
+        'solve_time': time.perf_counter() - start,
+    }
+    if result is not None:
+        output['solution_count'] = result.solution_count
+        output['unique'] = result.unique
+        output['stats'] = result.stats
+    if error is not None:
+        output['error'] = error
+    return output
+
+
+def solve_batch(
+    puzzles,
+    workers=None,
+    timeout=None,
+    max_in_flight=None,
+    memory_limit=None,
+    engine='python',
+    max_solutions=1,
+    cache=None
+):
+    # Yields one result dict per puzzle in completion order. At most
+    # max_in_flight puzzles are submitted at a time, so a huge input stream
+    # is never read into memory ahead of the workers.
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    options = (timeout, engine, max_solutions, cache)
+    submitted = {}
+
+    executor = start_pool(workers, memory_limit)
+    try:
+        for index, puzzle in enumerate(puzzles):
+            while len(submitted) >= max_in_flight:
+                executor = yield from collect_done(
+                    executor, submitted, workers, memory_limit, options
+                )
+
+            try:
+                future = executor.submit(solve_puzzle, index, puzzle, *options)
+            except BrokenProcessPool:
+                executor = yield from restart_pool(
+                    executor, submitted, workers, memory_limit, options
+                )
+                future = executor.submit(solve_puzzle, index, puzzle, *options)
+            submitted[future] = (index, puzzle, time.perf_counter())
+
+        while submitted:
+            executor = yield from collect_done(
+                executor, submitted, workers, memory_limit, options
+            )
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def collect_done(executor, submitted, workers, memory_limit, options):
+    # Yields the results that are ready and returns the executor to go on
+    # with, a new one if a worker died and broke the pool
+    done, _ = wait(submitted, return_when=FIRST_COMPLETED)
+    broken = False
+    for future in done:
+        if isinstance(future.exception(), BrokenProcessPool):
+            broken = True
+        else:
+            yield collect(future, submitted.pop(future))
+    if broken:
+        executor = yield from restart_pool(
+            executor, submitted, workers, memory_limit, options
+        )
+    return executor
+
+
+def restart_pool(executor, submitted, workers, memory_limit, options):
+    # A dead worker (e.g. killed by the OS for running out of memory) fails
+    # every puzzle in flight, not just its own. Those puzzles are rerun one
+    # per process so only the one that kills its worker again is reported
+    # as an error, then the rest of the stream goes to a fresh pool.
+    executor.shutdown(wait=False, cancel_futures=True)
+    wait(submitted)
+    suspects = []
+    for future, submission in list(submitted.items()):
+        if isinstance(future.exception(), BrokenProcessPool):
+            suspects.append(submission)
+        else:
+            yield collect(future, submission)
+    submitted.clear()
+
+    for first in range(0, len(suspects), workers):
+        isolated = {}
+        for index, puzzle, submitted_at in suspects[first:first + workers]:
+            pool = start_pool(1, memory_limit)
+            future = pool.submit(solve_puzzle, index, puzzle, *options)
+            isolated[future] = (pool, (index, puzzle, submitted_at))
+        wait(isolated)
+        for future, (pool, submission) in isolated.items():
+            yield collect(future, submission)
+            pool.shutdown()
+
+    return start_pool(workers, memory_limit)
+
+
+def collect(future, submission):
+    index, puzzle, submitted_at = submission
+    try:
+        result = future.result()
+    except Exception as e:
+        # The worker itself died (e.g. killed by the OS)
+        result = {
+            'index': index,
+            'id': puzzle.get('id') if isinstance(puzzle, dict) else None,
+            'status': 'error',
+            'grid': None,
+            'error': repr(e),
+        }
+    result['wall_time'] = time.perf_counter() - submitted_at
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Solve a stream of JSON lines puzzles on a process pool.'
+    )
+    parser.add_argument(
+        'puzzles', nargs='?', default='-',
+        help='JSON lines file of {"rows", "columns"} puzzles, - for stdin'
+    )
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument(
+        '--timeout', type=float, default=None,
+        help='seconds allowed per puzzle'
+    )
+    parser.add_argument(
+        '--max-in-flight', type=int, default=None,
+        help='puzzles submitted to the pool at once, default 2 per worker'
+    )
+    parser.add_argument(
+        '--memory-limit', type=int, default=None,
+        help='address space limit per worker in megabytes'
+    )
+    parser.add_argument(
+        '--engine', choices=['python', 'numpy'], default='python'
+    )
+    parser.add_argument(
+        '--max-solutions', type=int, default=1,
+        help='stop after this many solutions per puzzle, 2 checks uniqueness'
+    )
+    parser.add_argument(
+        '--cache', help='SQLite file of cached solutions shared by the workers'
+    )
+    args = parser.parse_args(argv)
+
+    stream = sys.stdin if args.puzzles == '-' else open(args.puzzles)
+    try:
+        for result in solve_batch(
+            iter_puzzles(stream),
+            workers=args.workers,
+            timeout=args.timeout,
+            max_in_flight=args.max_in_flight,
+            memory_limit=args.memory_limit,
+            engine=args.engine,
+            max_solutions=args.max_solutions,
+            cache=args.cache
+        ):
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+if __name__ == '__main__':
+    main()
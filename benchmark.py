@@ -0,0 +1,185 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from main import (
+    CORPUS_PATH,
+    LINE_ENGINES,
+    Solver,
+    cross_check_line_engines,
+    load_corpus,
+)
+
+# Metrics compared against a baseline, and whether a change in them is
+# measured (noisy, needs an absolute floor) or counted (deterministic)
+METRICS = {
+    'time_median': True,
+    'peak_memory': True,
+    'line_solves': False,
+    'nodes': False,
+}
+
+# Timing differences below these are treated as noise
+MIN_TIME_DELTA = 0.01
+MIN_MEMORY_DELTA = 64 * 1024
+
+
+def benchmark_puzzle(puzzle, repeat, engine, max_solutions, line_engine='auto'):
+    times = []
+    for _ in range(repeat):
+        solver = Solver(
+            input_json=puzzle,
+            headless=True,
+            engine=engine,
+            line_engine=line_engine
+        )
+        start = time.perf_counter()
+        result = solver.solve(max_solutions)
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured on a separate run since tracing slows solving down
+    solver = Solver(
+        input_json=puzzle,
+        headless=True,
+        engine=engine,
+        line_engine=line_engine
+    )
+    tracemalloc.start()
+    try:
+        solver.solve(max_solutions)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': result.status,
+        'solution_count': result.solution_count,
+        'times': times,
+        'time_min': min(times),
+        'time_median': statistics.median(times),
+        'line_solves': result.stats['line_solves'],
+        'nodes': result.stats['nodes'],
+        'peak_memory': peak_memory,
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for puzzle_id, current in results['puzzles'].items():
+        previous = baseline['puzzles'].get(puzzle_id)
+        if previous is None:
+            continue
+
+        if current['status'] != previous['status']:
+            regressions.append('%s: status %s, was %s' % (
+                puzzle_id, current['status'], previous['status']
+            ))
+
+        for metric, measured in METRICS.items():
+            if metric not in previous:
+                continue
+            delta = current[metric] - previous[metric]
+            if measured:
+                floor = (
+                    MIN_TIME_DELTA if metric == 'time_median'
+                    else MIN_MEMORY_DELTA
+                )
+                if delta < floor:
+                    continue
+            if delta > previous[metric] * threshold:
+                regressions.append('%s: %s %s, was %s' % (
+                    puzzle_id, metric, current[metric], previous[metric]
+                ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the solver on the bundled puzzle corpus.'
+    )
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument(
+        '--only', nargs='*', default=None,
+        help='puzzle ids to run, all by default'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--engine', choices=['python', 'numpy'], default='python'
+    )
+    parser.add_argument(
+        '--line-engine', choices=['auto'] + list(LINE_ENGINES),
+        default='auto'
+    )
+    parser.add_argument('--max-solutions', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument(
+        '--baseline', help='results JSON from an earlier run to compare with'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help='allowed relative increase over the baseline, default 0.25'
+    )
+    parser.add_argument(
+        '--cross-check', type=int, metavar='LINES',
+        help='instead of benchmarking, run every line engine on this many '
+             'random lines and fail on any disagreement'
+    )
+    args = parser.parse_args(argv)
+
+    if args.cross_check:
+        mismatches = cross_check_line_engines(lines=args.cross_check)
+        for mismatch in mismatches:
+            print('MISMATCH ' + json.dumps(mismatch))
+        print('%d lines, %d mismatches' % (args.cross_check, len(mismatches)))
+        return 1 if mismatches else 0
+
+    results = {
+        'engine': args.engine,
+        'line_engine': args.line_engine,
+        'repeat': args.repeat,
+        'max_solutions': args.max_solutions,
+        'python': platform.python_version(),
+        'puzzles': {},
+    }
+    for puzzle in load_corpus(args.corpus):
+        if args.only and puzzle['id'] not in args.only:
+            continue
+        result = benchmark_puzzle(
+            puzzle,
+            args.repeat,
+            args.engine,
+            args.max_solutions,
+            args.line_engine
+        )
+        results['puzzles'][puzzle['id']] = result
+        print('%-16s %-10s %9.4fs %8d line solves %6d nodes %9d bytes' % (
+            puzzle['id'],
+            result['status'],
+            result['time_median'],
+            result['line_solves'],
+            result['nodes'],
+            result['peak_memory'],
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,1443 @@
+import argparse
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain, count
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 class UnsolvableStateException(Exception):
-    pass
+    # conflict optionally lists the known cells that together caused the
+    # contradiction, for nogood learning, and line the (is_row, index) of
+    # the line that could not be solved
+    conflict = None
+    line = None
 
 
-class SolvedException(Exception):
+class SearchStopped(Exception):
+    # Raised out of the search when the solver's should_stop says so
     pass
 
 
+IMPLIED_BY_PATH = 'path'
+
+
+def line_possibilities(choices, length, usability_mask):
+    # Forward/backward reachability over (block index, cell index). Each
+    # block is treated as its full cells plus one trailing empty cell, and
+    # the line gets a virtual empty cell at index `length` so that the last
+    # block has somewhere to put its separator.
+    blocks = [c for c in choices if c > 0]
+    count = len(blocks)
+
+    # empties_before[i] is the number of known empty cells in [0, i)
+    empties_before = [0] * (length + 1)
+    for i, value in enumerate(usability_mask):
+        empties_before[i + 1] = empties_before[i] + (value == 1)
+
+    can_be_empty = [value != 2 for value in usability_mask] + [True]
+
+    def can_be_full(start, size):
+        return empties_before[start + size] == empties_before[start]
+
+    # forward[j][i]: the first i cells can hold exactly the first j blocks
+    forward = [[False] * (length + 2) for _ in range(count + 1)]
+    forward[0][0] = True
+    for j in range(count + 1):
+        current = forward[j]
+        size = blocks[j - 1] if j > 0 else 0
+        for i in range(1, length + 2):
+            if not can_be_empty[i - 1]:
+                continue
+            if current[i - 1]:
+                current[i] = True
+                continue
+            start = i - size - 1
+            if (
+                    j > 0 and
+                    start >= 0 and
+                    forward[j - 1][start] and
+                    can_be_full(start, size)
+            ):
+                current[i] = True
+
+    # backward[j][i]: the cells from i onwards can hold exactly the blocks
+    # from j onwards
+    backward = [[False] * (length + 2) for _ in range(count + 1)]
+    backward[count][length + 1] = True
+    for j in range(count, -1, -1):
+        current = backward[j]
+        size = blocks[j] if j < count else 0
+        for i in range(length, -1, -1):
+            if current[i + 1] and can_be_empty[i]:
+                current[i] = True
+                continue
+            end = i + size
+            if (
+                    j < count and
+                    end <= length and
+                    can_be_empty[end] and
+                    backward[j + 1][end + 1] and
+                    can_be_full(i, size)
+            ):
+                current[i] = True
+
+    true_mask = [[False, False] for _ in range(length)]
+
+    # Every forward state past the start ends in an empty cell (either free
+    # or a block separator), so cell i can be empty exactly when some split
+    # of the blocks reaches i + 1 from both sides.
+    for i in range(length):
+        for j in range(count + 1):
+            if forward[j][i + 1] and backward[j][i + 1]:
+                true_mask[i][0] = True
+                break
+
+    # Difference array of how many valid block placements cover each cell
+    coverage = [0] * (length + 1)
+    for j, size in enumerate(blocks):
+        for start in range(length - size + 1):
+            if (
+                    forward[j][start] and
+                    can_be_empty[start + size] and
+                    backward[j + 1][start + size + 1] and
+                    can_be_full(start, size)
+            ):
+                coverage[start] += 1
+                coverage[start + size] -= 1
+
+    covered = 0
+    for i in range(length):
+        covered += coverage[i]
+        if covered:
+            true_mask[i][1] = True
+
+    if any(
+        a is False and b is False
+        for a, b in true_mask
+    ):
+        raise UnsolvableStateException('Unsolvable state')
+
+    return true_mask
+
+
+def iter_placements(choices, length, usability_mask):
+    # Lazily yields every placement of the blocks that agrees with the known
+    # cells, as a list of 0 (empty) / 1 (full) per cell
+    blocks = [c for c in choices if c > 0]
+
+    def rec_possibilities(remaining_choices, free_index, mask):
+        if not remaining_choices:
+            if not all([
+                (
+                    usability_mask == 0 or
+                    (usability_mask - 1 == suggested_value)
+                )
+                for suggested_value, usability_mask in
+                zip(mask, usability_mask)
+            ]):
+                return
+
+            yield mask[:]
+            return
+        for i in range(free_index, length - remaining_choices[0] + 1):
+            # If a block can't be placed here anymore, skip the recursion
+            if any([
+                p == 1 for p in usability_mask[i:i + remaining_choices[0]]
+            ]):
+                continue
+            # If such a space can't be left between this and previous
+            # block, skip the recursion
+            if any([
+                p == 2 for p in usability_mask[free_index:i]
+            ]):
+                continue
+
+            for j in range(remaining_choices[0]):
+                mask[i + j] = 1
+            yield from rec_possibilities(remaining_choices[1:],
+                                         i + remaining_choices[0] + 1, mask)
+            for j in range(remaining_choices[0]):
+                mask[i + j] = 0
+
+    return rec_possibilities(blocks, 0, [0] * length)
+
+
+def count_placements(choices, length, usability_mask):
+    # Same forward pass as line_possibilities, counting the ways to reach
+    # each state instead of flagging them. Every placement has exactly one
+    # path, so the count at the virtual last cell is the placement count.
+    blocks = [c for c in choices if c > 0]
+
+    empties_before = [0] * (length + 1)
+    for i, value in enumerate(usability_mask):
+        empties_before[i + 1] = empties_before[i] + (value == 1)
+
+    can_be_empty = [value != 2 for value in usability_mask] + [True]
+
+    previous = None
+    for j in range(len(blocks) + 1):
+        current = [0] * (length + 2)
+        if j == 0:
+            current[0] = 1
+        size = blocks[j - 1] if j > 0 else 0
+        for i in range(1, length + 2):
+            if not can_be_empty[i - 1]:
+                continue
+            ways = current[i - 1]
+            start = i - size - 1
+            if (
+                    j > 0 and
+                    start >= 0 and
+                    previous[start] and
+                    empties_before[start + size] == empties_before[start]
+            ):
+                ways += previous[start]
+            current[i] = ways
+        previous = current
+
+    return previous[length + 1]
+
+
+def quick_line(choices, length, empty, full):
+    # Cheap rules tried before the full line solver: zero clues, lines whose
+    # known full cells already add up to the clue, gluing blocks to known
+    # full cells at the edges (and capping them), then simple overlap of the
+    # blocks left over when the rest of the line is still blank. Returns the
+    # exact (can be empty, can be full) bitmasks when these rules settle the
+    # line and None otherwise.
+    blocks = [c for c in choices if c > 0]
+    line_mask = (1 << length) - 1
+
+    known_full = bin(full).count('1')
+    total = sum(blocks)
+    if known_full > total:
+        raise UnsolvableStateException('Unsolvable state')
+    if known_full == total:
+        if bit_runs(full) != blocks:
+            raise UnsolvableStateException('Unsolvable state')
+        return line_mask & ~full, full
+
+    # Blocks first..last - 1 are still to be placed in cells low..high - 1
+    low, high = 0, length
+    first, last = 0, len(blocks)
+    while first < last:
+        while low < high and empty >> low & 1:
+            low += 1
+        if low == high or not full >> low & 1:
+            break
+        size = blocks[first]
+        if low + size > high:
+            raise UnsolvableStateException('Unsolvable state')
+        cells = ((1 << size) - 1) << low
+        if empty & cells or full >> low + size & 1:
+            raise UnsolvableStateException('Unsolvable state')
+        full |= cells
+        empty |= 1 << low + size
+        low = min(low + size + 1, high)
+        first += 1
+    while first < last:
+        while high > low and empty >> high - 1 & 1:
+            high -= 1
+        if high == low or not full >> high - 1 & 1:
+            break
+        size = blocks[last - 1]
+        if high - size < low:
+            raise UnsolvableStateException('Unsolvable state')
+        cells = ((1 << size) - 1) << high - size
+        if empty & cells or high > size and full >> high - size - 1 & 1:
+            raise UnsolvableStateException('Unsolvable state')
+        full |= cells
+        if high > size:
+            empty |= 1 << high - size - 1
+        high = max(high - size - 1, low)
+        last -= 1
+
+    segment = ((1 << high - low) - 1) << low
+    if first == last:
+        if full & segment:
+            raise UnsolvableStateException('Unsolvable state')
+        return line_mask & ~full, full
+    if (empty | full) & segment:
+        return None
+
+    # Nothing is known between low and high, so the cells the leftmost and
+    # rightmost placements of a block both cover are exactly its forced
+    # cells, and cells are only forced empty when the blocks fit exactly
+    remaining = blocks[first:last]
+    slack = high - low - sum(remaining) - max(len(remaining) - 1, 0)
+    if slack < 0:
+        raise UnsolvableStateException('Unsolvable state')
+    start = low
+    forced_full = 0
+    for size in remaining:
+        if size > slack:
+            forced_full |= ((1 << size - slack) - 1) << start + slack
+        start += size + 1
+    forced_empty = segment & ~forced_full if slack == 0 else 0
+
+    full |= forced_full
+    empty |= forced_empty
+    return line_mask & ~full, line_mask & ~empty
+
+
+def first_bit(bits, start):
+    # Index of the lowest set bit at or above start, or None
+    bits >>= start
+    if not bits:
+        return None
+    return (bits & -bits).bit_length() - 1 + start
+
+
+def leftmost_starts(blocks, length, empty, full, lower=None):
+    # Start of every block in the leftmost valid placement, which is also
+    # the earliest start each block has in any valid placement. Blocks are
+    # placed left to right at the first spot clear of empty cells and not
+    # touching a full cell; when a full cell is left uncovered behind a
+    # block, the block before has to move right to cover it. lower can give
+    # known earliest starts (from fewer known cells) to start the search at.
+    if lower is None:
+        lower = [0] * len(blocks)
+    starts = [0] * len(blocks)
+    minimum = list(lower)
+    j = 0
+    while True:
+        if j == len(blocks):
+            # Every block is placed; a full cell after the last one must be
+            # pulled in by moving blocks right
+            end = starts[-1] + blocks[-1] if blocks else 0
+            uncovered = first_bit(full, end)
+            if uncovered is None:
+                return starts
+            j -= 1
+        else:
+            base = starts[j - 1] + blocks[j - 1] + 1 if j else 0
+            uncovered = first_bit(full, base)
+            size = blocks[j]
+            start = max(minimum[j], base)
+            while uncovered is None or start <= uncovered:
+                if start + size > length:
+                    raise UnsolvableStateException('Unsolvable state')
+                blocked = first_bit(empty & ((1 << start + size) - 1), start)
+                if blocked is not None:
+                    start = blocked + 1
+                elif full >> start + size & 1:
+                    start += 1
+                else:
+                    break
+            else:
+                # This block can't reach the uncovered cell, so the one
+                # before it has to
+                j -= 1
+                if j < 0:
+                    raise UnsolvableStateException('Unsolvable state')
+                minimum[j] = uncovered - blocks[j] + 1
+                for later in range(j + 1, len(blocks)):
+                    minimum[later] = lower[later]
+                continue
+            starts[j] = start
+            j += 1
+            continue
+
+        if j < 0:
+            raise UnsolvableStateException('Unsolvable state')
+        minimum[j] = uncovered - blocks[j] + 1
+        for later in range(j + 1, len(blocks)):
+            minimum[later] = lower[later]
+
+
+def reverse_bits(bits, length):
+    return int(format(bits, '0%db' % length)[::-1], 2) if length else 0
+
+
+def rightmost_starts(blocks, length, empty, full, upper=None):
+    # Start of every block in the rightmost valid placement, found as the
+    # leftmost placement of the mirrored line. upper can give known latest
+    # starts to start the search at.
+    mirrored = leftmost_starts(
+        blocks[::-1],
+        length,
+        reverse_bits(empty, length),
+        reverse_bits(full, length),
+        None if upper is None else [
+            length - start - size
+            for start, size in zip(upper[::-1], blocks[::-1])
+        ]
+    )
+    return [
+        length - start - size
+        for start, size in zip(mirrored[::-1], blocks)
+    ]
+
+
+def block_bounds(blocks, length, empty, full):
+    # Earliest and latest start of every block over all valid placements
+    return (
+        leftmost_starts(blocks, length, empty, full),
+        rightmost_starts(blocks, length, empty, full)
+    )
+
+
+def placement_cells(blocks, starts):
+    # Bitmask of the cells a placement covers
+    cells = 0
+    for start, size in zip(starts, blocks):
+        cells |= ((1 << size) - 1) << start
+    return cells
+
+
+def bounds_cells(blocks, length, earliest, latest):
+    # Cells the bounds alone fix: a block covers the overlap of its
+    # earliest and latest placement, and cells no block can reach are
+    # empty. Returns (empty, full) bitmasks.
+    reach = 0
+    full = 0
+    for low, high, size in zip(earliest, latest, blocks):
+        reach |= ((1 << high + size - low) - 1) << low
+        if high < low + size:
+            full |= ((1 << low + size - high) - 1) << high
+    return ((1 << length) - 1) & ~reach, full
+
+
+# Shorter lines are cheaper to solve whole than to find (or keep) the
+# bounds for
+SPLIT_MIN_LENGTH = 64
+
+
+def split_line(blocks, length, empty, full, bounds=None):
+    # Splits the line wherever every valid placement puts the same blocks
+    # on either side: between block k - 1's latest end and block k's
+    # earliest start all cells are empty, so the two sides are independent
+    # lines. Cells outside the first and last block's reach are dropped the
+    # same way. bounds can pass in the block_bounds already known for the
+    # line. Returns (start, end, blocks) segments.
+    if not blocks:
+        return []
+    if bounds is None:
+        bounds = block_bounds(blocks, length, empty, full)
+    earliest, latest = bounds
+    segments = []
+    first = 0
+    for k in range(1, len(blocks) + 1):
+        if k < len(blocks) and latest[k - 1] + blocks[k - 1] >= earliest[k]:
+            continue
+        segments.append((
+            earliest[first],
+            latest[k - 1] + blocks[k - 1],
+            blocks[first:k]
+        ))
+        first = k
+    return segments
+
+
+@lru_cache(maxsize=4096)
+def compile_clue(choices):
+    # A nondeterministic automaton accepting the lines that match the clue,
+    # with state i as bit i so a set of states is one int. State 0 is the
+    # start; each block contributes one state per full cell followed by one
+    # empty cell state, which loops so gaps can be any length. Returns
+    # (states entered on a full cell, states entered on an empty cell,
+    # states that loop on an empty cell, accepting states).
+    on_full = 0
+    on_empty = 0
+    loops = 1
+    state = 0
+    for size in choices:
+        if size <= 0:
+            continue
+        for _ in range(size):
+            state += 1
+            on_full |= 1 << state
+        state += 1
+        on_empty |= 1 << state
+        loops |= 1 << state
+    accepting = 1 << state
+    if state:
+        accepting |= 1 << state - 1
+    return on_full, on_empty, loops, accepting
+
+
+def automaton_line(choices, length, empty, full):
+    # Runs the clue's automaton over the line forwards, keeping the reached
+    # state set per cell, then backwards from the accepting states; a value
+    # is possible for a cell when a forward state steps on it into a state
+    # that can still reach the end
+    on_full, on_empty, loops, accepting = compile_clue(tuple(choices))
+
+    forward = [1]
+    states = 1
+    for i in range(length):
+        reached = 0
+        if not full >> i & 1:
+            reached = (states << 1) & on_empty | states & loops
+        if not empty >> i & 1:
+            reached |= (states << 1) & on_full
+        states = reached
+        forward.append(states)
+    if not states & accepting:
+        raise UnsolvableStateException('Unsolvable state')
+
+    can_be_empty = 0
+    can_be_full = 0
+    viable = accepting
+    for i in range(length - 1, -1, -1):
+        states = forward[i]
+        previous = 0
+        if not full >> i & 1 and (
+                ((states << 1) & on_empty | states & loops) & viable
+        ):
+            can_be_empty |= 1 << i
+            previous = (viable & on_empty) >> 1 | viable & loops
+        if not empty >> i & 1 and (states << 1) & on_full & viable:
+            can_be_full |= 1 << i
+            previous |= (viable & on_full) >> 1
+        viable = previous
+
+    if can_be_empty | can_be_full != (1 << length) - 1:
+        raise UnsolvableStateException('Unsolvable state')
+    return can_be_empty, can_be_full
+
+
+def dp_line(choices, length, empty, full):
+    return bits_from_mask(line_possibilities(
+        choices, length, line_from_bits(empty, full, length)
+    ))
+
+
+def enumerate_line(choices, length, empty, full):
+    can_be_empty = 0
+    can_be_full = 0
+    line_mask = (1 << length) - 1
+    for placement in iter_placements(
+        choices, length, line_from_bits(empty, full, length)
+    ):
+        placed = 0
+        for i, value in enumerate(placement):
+            if value:
+                placed |= 1 << i
+        can_be_full |= placed
+        can_be_empty |= line_mask & ~placed
+        if can_be_empty & can_be_full == line_mask:
+            break
+    if can_be_empty | can_be_full != line_mask:
+        raise UnsolvableStateException('Unsolvable state')
+    return can_be_empty, can_be_full
+
+
+# Full line solvers by name. Each takes (clue, length, known empty bits,
+# known full bits) and returns the (can be empty, can be full) bitmasks, or
+# raises UnsolvableStateException.
+LINE_ENGINES = {
+    'automaton': automaton_line,
+    'dp': dp_line,
+    'enumerate': enumerate_line,
+}
+
+
+def select_line_engine(length, clue_count, known):
+    # Picks the engine for a line that quick_line couldn't settle. On random
+    # lines of 10 to 1000 cells, with anywhere from one unknown cell to
+    # none known, the automaton beat the dp by 3x on short lines and 30x
+    # on long lines with many blocks, and the enumerator by more still, so
+    # it gets every line until a faster engine for some shape of line is
+    # registered. The line shape arguments are unused until then but kept
+    # so such an engine can be slotted in without touching the callers.
+    return 'automaton'
+
+
+def cross_check_line_engines(engines=None, lines=1000, max_length=20, seed=None):
+    # Differential test: runs the engines on the same random lines and
+    # returns the lines they disagree on. Most lines are consistent with a
+    # random solution; some get a few wrong known cells or a random clue so
+    # contradictions are compared too.
+    engines = engines or list(LINE_ENGINES)
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(lines):
+        length = rng.randint(1, max_length)
+        solution = [rng.random() < 0.55 for _ in range(length)]
+        if rng.random() < 0.1:
+            clue = [rng.randint(1, 4) for _ in range(rng.randint(1, 4))]
+        else:
+            clue = bit_runs(sum(1 << i for i, v in enumerate(solution) if v))
+        clue = clue or [0]
+
+        known = rng.choice([0, 0.2, 0.5, 0.8])
+        empty = 0
+        full = 0
+        for i, value in enumerate(solution):
+            if rng.random() < known:
+                if rng.random() < 0.03:
+                    value = not value
+                if value:
+                    full |= 1 << i
+                else:
+                    empty |= 1 << i
+
+        results = {}
+        for name in engines:
+            try:
+                results[name] = LINE_ENGINES[name](clue, length, empty, full)
+            except UnsolvableStateException:
+                results[name] = None
+        if len(set(results.values())) > 1:
+            mismatches.append({
+                'clue': clue,
+                'length': length,
+                'empty': empty,
+                'full': full,
+                'results': results,
+            })
+    return mismatches
+
+
+def clue_blocks_array(clues):
+    # Pads the non-zero blocks of every clue into a (lines, max blocks)
+    # matrix, returned together with the per-line block counts
+    blocks = [[c for c in clue if c > 0] for clue in clues]
+    width = max([len(b) for b in blocks] + [1])
+    padded = numpy.zeros((len(blocks), width), dtype=numpy.int64)
+    for i, b in enumerate(blocks):
+        padded[i, :len(b)] = b
+    counts = numpy.array([len(b) for b in blocks], dtype=numpy.int64)
+    return padded, counts
+
+
+def batch_line_possibilities(lines, blocks, counts):
+    # Vectorized version of line_possibilities for a batch of lines of the
+    # same length. `lines` is a (batch, length) array of cell states,
+    # `blocks`/`counts` come from clue_blocks_array. The forward and
+    # backward chains of empty cells are resolved with running max/min over
+    # index arrays, so each block index costs a fixed number of array
+    # operations.
+    batch, length = lines.shape
+    max_count = blocks.shape[1]
+    rows = numpy.arange(batch)[:, None]
+    positions = numpy.arange(length + 2)[None, :]
+    no_index = length + 2
+
+    empties_before = numpy.zeros((batch, length + 1), dtype=numpy.int64)
+    numpy.cumsum(lines == 1, axis=1, out=empties_before[:, 1:])
+    can_be_empty = numpy.ones((batch, length + 2), dtype=bool)
+    can_be_empty[:, :length] = lines != 2
+
+    def can_be_full(start, size):
+        start = numpy.clip(start, 0, length)
+        end = numpy.clip(start + size, 0, length)
+        return empties_before[rows, end] == empties_before[rows, start]
+
+    # Cell i - 1 must be empty for the forward chain to step onto i
+    forward_blocked = ~can_be_empty[:, :length + 1]
+    forward_blocked = numpy.concatenate(
+        [numpy.zeros((batch, 1), dtype=bool), forward_blocked], axis=1
+    )
+    last_blocked = numpy.maximum.accumulate(
+        numpy.where(forward_blocked, positions, -1), axis=1
+    )
+
+    forward = numpy.zeros((max_count + 1, batch, length + 2), dtype=bool)
+    for j in range(max_count + 1):
+        if j == 0:
+            seeds = numpy.zeros((batch, length + 2), dtype=bool)
+            seeds[:, 0] = True
+        else:
+            size = blocks[:, j - 1:j]
+            start = positions - size - 1
+            clipped = numpy.clip(start, 0, length + 1)
+            seeds = (
+                (j <= counts)[:, None] &
+                (start >= 0) &
+                forward[j - 1][rows, clipped] &
+                can_be_full(clipped, size) &
+                ~forward_blocked
+            )
+        last_seed = numpy.maximum.accumulate(
+            numpy.where(seeds, positions, -1), axis=1
+        )
+        forward[j] = last_seed > last_blocked
+
+    # Cell i must be empty for the backward chain to step from i + 1 onto i
+    backward_blocked = numpy.zeros((batch, length + 2), dtype=bool)
+    backward_blocked[:, :length + 1] = ~can_be_empty[:, :length + 1]
+    next_blocked = numpy.minimum.accumulate(
+        numpy.where(backward_blocked, positions, no_index)[:, ::-1], axis=1
+    )[:, ::-1]
+
+    backward = numpy.zeros((max_count + 1, batch, length + 2), dtype=bool)
+    placements = numpy.zeros((max_count, batch, length + 2), dtype=bool)
+    for j in range(max_count, -1, -1):
+        seeds = numpy.zeros((batch, length + 2), dtype=bool)
+        seeds[:, length + 1] = counts == j
+        if j < max_count:
+            size = blocks[:, j:j + 1]
+            end = positions + size
+            clipped = numpy.clip(end, 0, length)
+            placements[j] = (
+                (j < counts)[:, None] &
+                (end <= length) &
+                can_be_empty[rows, clipped] &
+                backward[j + 1][rows, numpy.clip(end + 1, 0, length + 1)] &
+                can_be_full(positions, size)
+            )
+            seeds |= placements[j]
+        next_seed = numpy.minimum.accumulate(
+            numpy.where(seeds, positions, no_index + 1)[:, ::-1], axis=1
+        )[:, ::-1]
+        backward[j] = next_seed <= next_blocked
+
+    possible_empty = (
+        forward[:, :, 1:length + 1] & backward[:, :, 1:length + 1]
+    ).any(axis=0)
+
+    possible_full = numpy.zeros((batch, length), dtype=bool)
+    for j in range(max_count):
+        size = blocks[:, j:j + 1]
+        starts = (forward[j] & placements[j])[:, :length + 1]
+        started = numpy.zeros((batch, length + 2), dtype=numpy.int64)
+        numpy.cumsum(starts, axis=1, out=started[:, 1:])
+        # Cell i is covered by a start in (i - size, i]
+        cells = positions[:, :length]
+        possible_full |= (
+            started[rows, cells + 1] >
+            started[rows, numpy.clip(cells - size + 1, 0, length + 1)]
+        )
+
+    if (~possible_empty & ~possible_full).any():
+        raise UnsolvableStateException('Unsolvable state')
+
+    return possible_empty, possible_full
+
+
+def iter_bits(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def bit_runs(bits):
+    # Lengths of the runs of set bits, lowest first
+    runs = []
+    while bits:
+        bits >>= (bits & -bits).bit_length() - 1
+        size = (bits ^ (bits + 1)).bit_length() - 1
+        runs.append(size)
+        bits >>= size
+    return runs
+
+
+def check_line(choices, full):
+    # Raises unless the full cells of a complete line match its clue
+    if bit_runs(full) != [c for c in choices if c > 0]:
+        raise UnsolvableStateException('Unsolvable state')
+
+
+def line_from_bits(empty, full, length):
+    return [
+        (empty >> i & 1) | (full >> i & 1) << 1
+        for i in range(length)
+    ]
+
+
+def bits_from_mask(true_mask):
+    can_be_empty = 0
+    can_be_full = 0
+    for i, (possible_empty, possible_full) in enumerate(true_mask):
+        if possible_empty:
+            can_be_empty |= 1 << i
+        if possible_full:
+            can_be_full |= 1 << i
+    return can_be_empty, can_be_full
+
+
+def unpack_bits(values, length):
+    size = max((length + 7) // 8, 1)
+    data = numpy.frombuffer(
+        b''.join(v.to_bytes(size, 'little') for v in values),
+        dtype=numpy.uint8
+    ).reshape(len(values), size)
+    return numpy.unpackbits(
+        data, axis=1, bitorder='little'
+    )[:, :length].astype(numpy.int8)
+
+
+def pack_bits(bits):
+    return [
+        int.from_bytes(row.tobytes(), 'little')
+        for row in numpy.packbits(bits, axis=1, bitorder='little')
+    ]
+
+
+# The eight symmetries of a rectangle as (flip rows, flip columns,
+# transpose), applied in that order
+SYMMETRIES = [
+    (flip_rows, flip_columns, transpose)
+    for transpose in (False, True)
+    for flip_rows in (False, True)
+    for flip_columns in (False, True)
+]
+
+
+def transform_clues(rows, columns, symmetry):
+    flip_rows, flip_columns, transpose = symmetry
+    rows = [list(clue) for clue in rows]
+    columns = [list(clue) for clue in columns]
+    if flip_rows:
+        rows = rows[::-1]
+        columns = [clue[::-1] for clue in columns]
+    if flip_columns:
+        columns = columns[::-1]
+        rows = [clue[::-1] for clue in rows]
+    if transpose:
+        rows, columns = columns, rows
+    return rows, columns
+
+
+def transform_grid(grid, symmetry):
+    flip_rows, flip_columns, transpose = symmetry
+    grid = [list(row) for row in grid]
+    if flip_rows:
+        grid = grid[::-1]
+    if flip_columns:
+        grid = [row[::-1] for row in grid]
+    if transpose:
+        grid = [list(column) for column in zip(*grid)]
+    return grid
+
+
+def restore_grid(grid, symmetry):
+    # Inverse of transform_grid
+    flip_rows, flip_columns, transpose = symmetry
+    if transpose:
+        grid = [list(column) for column in zip(*grid)]
+    return transform_grid(grid, (flip_rows, flip_columns, False))
+
+
+def canonical_puzzle(rows, columns):
+    # Returns (key, symmetry) where key is the same for every mirrored or
+    # transposed version of the puzzle and symmetry maps this version onto
+    # the canonical one. Zero clues are dropped so [0] and [] match.
+    rows = [[c for c in clue if c > 0] for clue in rows]
+    columns = [[c for c in clue if c > 0] for clue in columns]
+    text, symmetry = min(
+        (json.dumps(transform_clues(rows, columns, symmetry)), symmetry)
+        for symmetry in SYMMETRIES
+    )
+    return hashlib.sha256(text.encode()).hexdigest(), symmetry
+
+
+def pack_grid(grid):
+    bits = 0
+    for i, value in enumerate(value for row in grid for value in row):
+        if value:
+            bits |= 1 << i
+    size = (len(grid) * len(grid[0]) + 7) // 8 if grid else 0
+    return bits.to_bytes(size, 'little')
+
+
+def unpack_grid(data, height, width):
+    bits = int.from_bytes(data, 'little')
+    return [
+        [bits >> (x * width + y) & 1 for y in range(width)]
+        for x in range(height)
+    ]
+
+
+class Grid:
+    # Cell states are stored as two bitmasks per row (known empty, known
+    # full), mirrored per column, so that reading a whole line, cloning and
+    # checking for completion are word operations. Cell values use the same
+    # encoding as the rest of the solver: 0 unknown, 1 empty, 2 full.
+    # Unknown cells are counted per line and overall as cells are set, so
+    # finding open lines and checking for completion cost nothing.
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.row_empty = [0] * height
+        self.row_full = [0] * height
+        self.column_empty = [0] * width
+        self.column_full = [0] * width
+        self.row_unknown = [width] * height
+        self.column_unknown = [height] * width
+        self.unknown = height * width
+
+    def clone(self):
+        new_grid = Grid.__new__(Grid)
+        new_grid.height = self.height
+        new_grid.width = self.width
+        new_grid.row_empty = self.row_empty[:]
+        new_grid.row_full = self.row_full[:]
+        new_grid.column_empty = self.column_empty[:]
+        new_grid.column_full = self.column_full[:]
+        new_grid.row_unknown = self.row_unknown[:]
+        new_grid.column_unknown = self.column_unknown[:]
+        new_grid.unknown = self.unknown
+        return new_grid
+
+    def get(self, x, y):
+        return (
+            (self.row_empty[x] >> y & 1) |
+            (self.row_full[x] >> y & 1) << 1
+        )
+
+    def set(self, x, y, value):
+        row_bit = 1 << y
+        column_bit = 1 << x
+        if (self.row_empty[x] | self.row_full[x]) & row_bit:
+            self.row_empty[x] &= ~row_bit
+            self.row_full[x] &= ~row_bit
+            self.column_empty[y] &= ~column_bit
+            self.column_full[y] &= ~column_bit
+            if not value:
+                self.row_unknown[x] += 1
+                self.column_unknown[y] += 1
+                self.unknown += 1
+        elif value:
+            self.row_unknown[x] -= 1
+            self.column_unknown[y] -= 1
+            self.unknown -= 1
+        if value == 1:
+            self.row_empty[x] |= row_bit
+            self.column_empty[y] |= column_bit
+        elif value == 2:
+            self.row_full[x] |= row_bit
+            self.column_full[y] |= column_bit
+
+    def row_bits(self, x):
+        return self.row_empty[x], self.row_full[x]
+
+    def column_bits(self, y):
+        return self.column_empty[y], self.column_full[y]
+
+    def row(self, x):
+        return line_from_bits(self.row_empty[x], self.row_full[x], self.width)
+
+    def column(self, y):
+        return line_from_bits(
+            self.column_empty[y], self.column_full[y], self.height
+        )
+
+    def rows(self):
+        return [self.row(x) for x in range(self.height)]
+
+    def filled(self):
+        return [
+            [full >> y & 1 for y in range(self.width)]
+            for full in self.row_full
+        ]
+
+    def is_solved(self):
+        return not self.unknown
+
+    def to_array(self):
+        return (
+            unpack_bits(self.row_empty, self.width) +
+            2 * unpack_bits(self.row_full, self.width)
+        )
+
+    def load_array(self, cells):
+        self.row_empty = pack_bits(cells == 1)
+        self.row_full = pack_bits(cells == 2)
+        self.column_empty = pack_bits((cells == 1).T)
+        self.column_full = pack_bits((cells == 2).T)
+        self.row_unknown = (cells == 0).sum(axis=1).tolist()
+        self.column_unknown = (cells == 0).sum(axis=0).tolist()
+        self.unknown = sum(self.row_unknown)
+
+
+class Clues:
+    # The clues of every row (or every column) of a puzzle in two flat
+    # arrays rather than a list per line: values holds all block sizes back
+    # to back and line i's clue is values[offsets[i]:offsets[i + 1]]
+    def __init__(self, clues=()):
+        self.values = array('H')
+        self.offsets = array('L', [0])
+        for clue in clues:
+            self.values.extend(clue)
+            self.end_line()
+
+    @classmethod
+    def from_text(cls, text):
+        # The string form, e.g. "2/1,2/3"
+        clues = cls()
+        for match in CLUE_TOKEN.finditer(text):
+            token = match.group()
+            if token == '/':
+                clues.end_line()
+            else:
+                clues.values.append(int(token))
+        clues.end_line()
+        return clues
+
+    def end_line(self):
+        self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('Clue index out of range')
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class LineCache:
+    # LRU cache of line solve results keyed by (clue, cell states). Clones
+    # share one instance so a branch never re-solves a line its parent (or a
+    # sibling branch) has already solved.
+    UNSOLVABLE = object()
+
+    def __init__(self, max_entries=200000, max_cells=20000000):
+        self.max_entries = max_entries
+        self.max_cells = max_cells
+        self.entries = OrderedDict()
+        self.cells = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            return
+        self.entries[key] = (value, size)
+        self.cells += size
+        while self.entries and (
+                len(self.entries) > self.max_entries or
+                self.cells > self.max_cells
+        ):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.cells -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'cells': self.cells,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class Instrumentation:
+    # Opt-in timers and counters for the solver's hot paths. The solver
+    # only calls into this when one is attached, so leaving it off costs
+    # an attribute check per event.
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.line_solves = {}
+        self.contradictions = defaultdict(int)
+        self.passes_by_depth = defaultdict(int)
+        self.cells_fixed = 0
+        self.cells_fixed_per_pass = defaultdict(int)
+        self.branches_by_depth = defaultdict(int)
+        self.max_depth = 0
+        self.clones = 0
+
+    def line_solve(self, length, clues, seconds):
+        entry = self.line_solves.setdefault((length, clues), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        self.timers['line_solve'] += seconds
+
+    def propagation(self, depth, cells, seconds):
+        self.timers['propagate'] += seconds
+        self.passes_by_depth[depth] += 1
+        self.cells_fixed += cells
+        # Bucketed by powers of two: 0, 1, 2-3, 4-7, ...
+        self.cells_fixed_per_pass[cells.bit_length()] += 1
+
+    def branch(self, depth):
+        self.branches_by_depth[depth] += 1
+        self.max_depth = max(self.max_depth, depth)
+
+    def contradiction(self, source):
+        self.contradictions[source] += 1
+
+    def merge(self, other, depth=0):
+        # Adds in the counts of a branch searched by another solver (in a
+        # worker process) whose root is depth levels down the search tree
+        for name, seconds in other.timers.items():
+            self.timers[name] += seconds
+        for key, (calls, seconds) in other.line_solves.items():
+            entry = self.line_solves.setdefault(key, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        for source, contradictions in other.contradictions.items():
+            self.contradictions[source] += contradictions
+        for branch_depth, passes in other.passes_by_depth.items():
+            self.passes_by_depth[branch_depth + depth] += passes
+        self.cells_fixed += other.cells_fixed
+        for bucket, passes in other.cells_fixed_per_pass.items():
+            self.cells_fixed_per_pass[bucket] += passes
+        for branch_depth, branches in other.branches_by_depth.items():
+            self.branches_by_depth[branch_depth + depth] += branches
+        self.max_depth = max(self.max_depth, other.max_depth + depth)
+        self.clones += other.clones
+
+    def to_dict(self):
+        return {
+            'timers': dict(self.timers),
+            'line_solves': [
+                {
+                    'length': length,
+                    'clues': clues,
+                    'calls': calls,
+                    'time': seconds,
+                }
+                for (length, clues), (calls, seconds) in sorted(
+                    self.line_solves.items()
+                )
+            ],
+            'contradictions': dict(self.contradictions),
+            'passes_by_depth': {
+                str(depth): count
+                for depth, count in sorted(self.passes_by_depth.items())
+            },
+            'cells_fixed': self.cells_fixed,
+            'cells_fixed_per_pass': {
+                (str(1 << bucket - 1) + '+' if bucket else '0'): count
+                for bucket, count in sorted(self.cells_fixed_per_pass.items())
+            },
+            'branches_by_depth': {
+                str(depth): count
+                for depth, count in sorted(self.branches_by_depth.items())
+            },
+            'max_depth': self.max_depth,
+            'clones': self.clones,
+        }
+
+
+class NogoodStore:
+    # Bounded LRU set of nogoods: combinations of cell assignments (x, y,
+    # value) known to lead to a contradiction. Each nogood is kept as
+    # per-row (empty, full) bitmasks so matching it against a grid is a few
+    # word operations per row it touches.
+    def __init__(self, max_nogoods=1000, max_size=256):
+        self.max_nogoods = max_nogoods
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.added = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, literals):
+        if not literals or len(literals) > self.max_size:
+            return
+        key = tuple(sorted(literals))
+        if key in self.entries:
+            return
+
+        rows = {}
+        for x, y, value in key:
+            empty, full = rows.get(x, (0, 0))
+            if value == 1:
+                empty |= 1 << y
+            else:
+                full |= 1 << y
+            rows[x] = (empty, full)
+        self.entries[key] = list(rows.items())
+        self.added += 1
+
+        while len(self.entries) > self.max_nogoods:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def match(self, table):
+        # Returns the first nogood the grid satisfies, or None
+        for key, rows in self.entries.items():
+            if all(
+                table.row_empty[x] & empty == empty and
+                table.row_full[x] & full == full
+                for x, (empty, full) in rows
+            ):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return key
+        return None
+
+    def stats(self):
+        return {
+            'nogoods': len(self.entries),
+            'added': self.added,
+            'hits': self.hits,
+            'evictions': self.evictions,
+        }
+
+
+class SolveResult:
+    # What Solver.solve() returns. solution_count is exact when complete is
+    # set, i.e. the search was exhausted before reaching max_solutions.
+    def __init__(self, status, solutions, complete, stats):
+        self.status = status
+        self.solutions = solutions
+        self.complete = complete
+        self.stats = stats
+
+    @property
+    def grid(self):
+        return self.solutions[0] if self.solutions else None
+
+    @property
+    def solution_count(self):
+        return len(self.solutions)
+
+    @property
+    def unique(self):
+        return self.complete and len(self.solutions) == 1
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'grid': self.grid,
+            'solution_count': self.solution_count,
+            'complete': self.complete,
+            'unique': self.unique,
+            'stats': self.stats,
+        }
+
+
+class SolutionCache:
+    # Persistent cache of solve results in SQLite, shared by every
+    # orientation of a puzzle: entries are keyed by canonical_puzzle and
+    # hold the solutions bit-packed in the canonical orientation. Least
+    # recently used entries are evicted past max_entries or max_bytes.
+    def __init__(self, path, max_entries=100000, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS solutions ('
+                'key TEXT PRIMARY KEY, '
+                'height INTEGER NOT NULL, '
+                'width INTEGER NOT NULL, '
+                'count INTEGER NOT NULL, '
+                'complete INTEGER NOT NULL, '
+                'data BLOB NOT NULL, '
+                'used REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS solutions_used '
+                'ON solutions (used)'
+            )
+            # Running totals, so checking the limits doesn't scan the table
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS totals ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                'entries INTEGER NOT NULL, '
+                'bytes INTEGER NOT NULL)'
+            )
+            self.connection.execute(
+                'INSERT OR IGNORE INTO totals VALUES (0, 0, 0)'
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, rows, columns, max_solutions=1):
+        # Returns a SolveResult in the caller's orientation, or None when
+        # the cache can't answer for max_solutions
+        key, symmetry = canonical_puzzle(rows, columns)
+        entry = self.connection.execute(
+            'SELECT height, width, count, complete, data FROM solutions '
+            'WHERE key = ?',
+            (key,)
+        ).fetchone()
+        if entry is None or not entry[3] and entry[2] < max_solutions:
+            self.misses += 1
+            return None
+        height, width, solution_count, complete, data = entry
+        self.hits += 1
+        with self.connection:
+            self.connection.execute(
+                'UPDATE solutions SET used = ? WHERE key = ?',
+                (time.time(), key)
+            )
+
+        size = (height * width + 7) // 8
+        solutions = [
+            restore_grid(
+                unpack_grid(data[i * size:(i + 1) * size], height, width),
+                symmetry
+            )
+            for i in range(min(solution_count, max_solutions))
+        ]
+        return SolveResult(
+            'solved' if solutions else 'unsolvable',
+            solutions,
+            bool(complete) and solution_count <= max_solutions,
+            {'cache': 'hit'}
+        )
+
+    def put(self, rows, columns, result):
+        if result.status not in ('solved', 'unsolvable'):
+            return
+        key, symmetry = canonical_puzzle(rows, columns)
+        height, width = len(rows), len(columns)
+        if symmetry[2]:
+            height, width = width, height
+        data = b''.join(
+            pack_grid(transform_grid(grid, symmetry))
+            for grid in result.solutions
+        )
+
+        with self.connection:
+            # Takes the write lock before reading, so a process putting the
+            # same puzzle at the same time waits for this one instead of
+            # failing its insert. Keeps whichever entry knows more.
+            self.connection.execute('BEGIN IMMEDIATE')
+            entry = self.connection.execute(
+                'SELECT count, complete, LENGTH(data) FROM solutions '
+                'WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if entry is not None:
+                solution_count, complete, length = entry
+                if complete or (
+                    solution_count >= result.solution_count and
+                    not result.complete
+                ):
+                    return
+                self.remove(key, length)
+
+            self.connection.execute(
+                'INSERT INTO solutions '
+                '(key, height, width, count, complete, data, used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key,
+                    height,
+                    width,
+                    result.solution_count,
+                    int(result.complete),
+                    data,
+                    time.time(),
+                )
+            )
+            self.connection.execute(
+                'UPDATE totals SET entries = entries + 1, bytes = bytes + ?',
+                (len(data),)
+            )
+            self.evict()
+
+    def remove(self, key, length):
+        self.connection.execute('DELETE FROM solutions WHERE key = ?', (key,))
+        self.connection.execute(
+            'UPDATE totals SET entries = entries - 1, bytes = bytes - ?',
+            (length,)
+        )
+
+    def evict(self):
+        while True:
+            entries, size = self.connection.execute(
+                'SELECT entries, bytes FROM totals'
+            ).fetchone()
+            if entries <= self.max_entries and size <= self.max_bytes:
+                return
+            key, length = self.connection.execute(
+                'SELECT key, LENGTH(data) FROM solutions ORDER BY used LIMIT 1'
+            ).fetchone()
+            self.remove(key, length)
+            self.evictions += 1
+
+    def solve(self, rows, columns, max_solutions=1, **options):
+        # Looks the puzzle up and only runs the Solver on a miss
+        result = self.get(rows, columns, max_solutions)
+        if result is not None:
+            return result
+        result = Solver(
+            rows=rows, columns=columns, headless=True, **options
+        ).solve(max_solutions)
+        result.stats['cache'] = 'miss'
+        try:
+            self.put(rows, columns, result)
+        except sqlite3.Error as e:
+            # The result stands even when it couldn't be stored
+            result.stats['cache_error'] = repr(e)
+        return result
+
+    def stats(self):
+        entries, size = self.connection.execute(
+            'SELECT entries, bytes FROM totals'
+        ).fetchone()
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SolverObserver:
+    # Progress hooks called by the solver. Subclasses override the events
+    # they care about; with no observer registered none of these are called.
+    def on_pass(self, solver):
+        pass
+
+    def on_guess(self, solver, x, y, candidates):
+        pass
+
+    def on_backtrack(self, solver, x, y, choice_option):
+        pass
+
+    def on_solved(self, solver):
+        pass
+
+
+class TextObserver(SolverObserver):
+    def on_pass(self, solver):
+        solver.print_table()
+
+    def on_solved(self, solver):
+        solver.print_table()
+        print('')
+        print(' ' + '*' * 30)
+        print(' * SOLVED :))))))))')
+        print(' ' + '*' * 30)
+
+
 class Solver:
     def __init__(
         self,
@@ -13,56 +1445,145 @@ class Solver:
         column_input=None,
         input_json=None,
         rows=None,
-        columns=None
+        columns=None,
+        line_cache=None,
+        engine='python',
+        line_engine='auto',
+        observer=None,
+        headless=False,
+        workers=1,
+        parallel_depth=1,
+        probe_budget=16,
+        learn_nogoods=False,
+        max_nogoods=1000,
+        instrumentation=None,
+        should_stop=None
     ):
         if input_json:
             self.columns = input_json['columns']
             self.rows = input_json['rows']
         if row_input:
-            self.columns = [
-                [int(i) for i in l.split(',')] for l in column_input.split('/')
-            ]
-            self.rows = [
-                [int(i) for i in l.split(',')] for l in row_input.split('/')
-            ]
+            self.columns = Clues.from_text(column_input)
+            self.rows = Clues.from_text(row_input)
         if rows:
             self.rows = rows
             self.columns = columns
 
-        self.rows_dirty = [True for _ in range(len(self.rows))]
-        self.columns_dirty = [True for _ in range(len(self.columns))]
+        # A line is dirty while it has an entry in the propagation queue.
+        # changes counts the crossing cells fixed since the line was last
+        # solved and feeds into its priority.
+        self.rows_dirty = bytearray(len(self.rows))
+        self.columns_dirty = bytearray(len(self.columns))
+        self.rows_changes = array('I', [0]) * len(self.rows)
+        self.columns_changes = array('I', [0]) * len(self.columns)
+        self.queue = []
+        self.queue_counter = count()
 
-        self.table = [
-            [
-                0
-                for _ in range(len(self.columns))
-            ]
-            for _ in range(len(self.rows))
-        ]
+        # Earliest and latest block starts per line, with the line state
+        # they were found for. Cells only get fixed as solving goes on, so
+        # the bounds only narrow and are updated from the cells fixed since;
+        # after an undo or a clue edit they no longer apply and are rebuilt.
+        self.row_bounds = [None] * len(self.rows)
+        self.column_bounds = [None] * len(self.columns)
+
+        # Every cell fixed since the grid was created, in order, so search
+        # can undo back to a decision point instead of copying the grid
+        self.trail = []
+
+        # With nogood learning (or under a SolveSession) every trail entry
+        # also gets a reason: None for a guessed cell, the (is_row, index,
+        # empty, full) state of the line that fixed it, or IMPLIED_BY_PATH
+        # when only the guesses made so far as a whole explain it (probing,
+        # numpy batches)
+        self.learn_nogoods = learn_nogoods
+        self.record_reasons = learn_nogoods
+        self.reasons = []
+        self.decision_indices = []
+        self.assigned_at = {}
+        self.nogoods = NogoodStore(max_nogoods)
+
+        self.table = Grid(len(self.rows), len(self.columns))
+
+        if line_cache is None:
+            line_cache = LineCache()
+        self.line_cache = line_cache
+
+        # The numpy engine solves all dirty rows (then columns) as one batch
+        # and falls back to the pure python path when numpy is unavailable
+        if engine == 'numpy' and numpy is None:
+            engine = 'python'
+        self.engine = engine
+        if self.engine == 'numpy':
+            self.row_blocks = clue_blocks_array(self.rows)
+            self.column_blocks = clue_blocks_array(self.columns)
+
+        # The full line solver from LINE_ENGINES, or auto to pick one per
+        # line with select_line_engine
+        if line_engine != 'auto' and line_engine not in LINE_ENGINES:
+            raise ValueError('Unknown line engine %s' % line_engine)
+        self.line_engine = line_engine
+
+        if observer is None and not headless:
+            observer = TextObserver()
+        self.observer = observer
+
+        # With more than one worker, guessing farms its branches (down to
+        # parallel_depth levels) out to a process pool
+        self.workers = workers
+        self.parallel_depth = parallel_depth
+
+        # Cells tried per probing round before falling back to guessing,
+        # 0 disables probing
+        self.probe_budget = probe_budget
 
-        self.hardness_index = 2
-        self.changes_table = True
+        self.max_solutions = 1
+        self.solutions = []
+        self.reset_stats()
+        self.depth = 0
+
+        # Pass instrumentation=Instrumentation() for detailed timings
+        self.instrumentation = instrumentation
+
+        # Checked at every search node; once it returns true the search is
+        # abandoned and solve() reports the status stopped
+        self.should_stop = should_stop
+
+        self.schedule_all()
 
     def clone(self):
+        if self.instrumentation is not None:
+            self.instrumentation.clones += 1
         new_solver = Solver(
             rows=self.rows,
-            columns=self.columns
+            columns=self.columns,
+            line_cache=self.line_cache,
+            engine=self.engine,
+            line_engine=self.line_engine,
+            observer=self.observer,
+            headless=True,
+            probe_budget=self.probe_budget,
+            learn_nogoods=self.learn_nogoods,
+            max_nogoods=self.nogoods.max_nogoods,
+            should_stop=self.should_stop
         )
-        new_solver.table = [i[:] for i in self.table]  # Deep copy
+        new_solver.table = self.table.clone()
+        new_solver.row_bounds = list(self.row_bounds)
+        new_solver.column_bounds = list(self.column_bounds)
 
         return new_solver
 
+    def reset_stats(self):
+        self.nodes = 0
+        self.guesses = 0
+        self.backtracks = 0
+        self.line_solves = 0
+        self.quick_solves = 0
+        self.bound_solves = 0
+        self.split_solves = 0
+        self.line_engine_solves = defaultdict(int)
 
     def is_solved(self):
-        all_filled = not any([
-            any([
-                c == 0
-                for c in row
-            ])
-            for row in self.table
-        ])
-
-        return all_filled
+        return self.table.is_solved()
 
     def print_table(self):
         print('Table:')
@@ -80,7 +1601,7 @@ class Solver:
 
         for row_index, row_text in enumerate([
             ''.join([{0: '-', 1: ' ', 2: '#'}[i] for i in t])
-            for t in self.table
+            for t in self.table.rows()
         ]):
             print(
                 ('D' if self.rows_dirty[row_index] else ' ') +
@@ -88,662 +1609,1224 @@ class Solver:
                 row_text
             )
 
-    def possibilities(self, choices, length, usability_mask, gather_all_choices=False):
-        true_mask = [[False, False] for _ in range(length)]
-        all_choices = []
+    def solve_line(self, choices, length, empty, full, line=None):
+        # Returns (can be empty, can be full) bitmasks for a line given as
+        # known-empty / known-full bitmasks. line is the (is_row, index) of
+        # a grid line, whose block bounds are then kept between solves.
+        self.line_solves += 1
+        if self.instrumentation is None:
+            return self.lookup_line(choices, length, empty, full, line)
 
-        def rec_possibilities(remaining_choices, free_index, mask):
-            if not remaining_choices:
-                if not all([
-                    (
-                        usability_mask == 0 or
-                        (usability_mask - 1 == suggested_value)
-                    )
-                    for suggested_value, usability_mask in
-                    zip(mask, usability_mask)
-                ]):
-                    return
+        start = time.perf_counter()
+        try:
+            return self.lookup_line(choices, length, empty, full, line)
+        except UnsolvableStateException:
+            self.instrumentation.contradiction('line')
+            raise
+        finally:
+            self.instrumentation.line_solve(
+                length, len(choices), time.perf_counter() - start
+            )
 
-                if gather_all_choices:
-                    all_choices.append(mask[:])
-                for i, value in enumerate(mask):
-                    true_mask[i][value] = True
-                return
-            for i in range(free_index, length - remaining_choices[0] + 1):
-                # If a block can't be placed here anymore, skip the recursion
-                if any([
-                    p == 1 for p in usability_mask[i:i + remaining_choices[0]]
-                ]):
-                    continue
-                # If such a space can't be left between this and previous
-                # block, skip the recursion
-                if any([
-                    p == 2 for p in usability_mask[free_index:i]
-                ]):
-                    continue
-
-                for j in range(remaining_choices[0]):
-                    mask[i + j] = 1
-                rec_possibilities(remaining_choices[1:],
-                                  i + remaining_choices[0] + 1, mask)
-                for j in range(remaining_choices[0]):
-                    mask[i + j] = 0
-
-        rec_possibilities(choices, 0, [0] * length)
-
-        if any(
-            a is False and b is False
-            for a, b in true_mask
+    def lookup_line(self, choices, length, empty, full, line=None):
+        result = quick_line(choices, length, empty, full)
+        if result is not None:
+            self.quick_solves += 1
+            return result
+
+        blocks = [c for c in choices if c > 0]
+        if length < SPLIT_MIN_LENGTH:
+            return self.solve_segment(blocks, length, empty, full)
+        if line is None:
+            bounds = block_bounds(blocks, length, empty, full)
+        else:
+            # The cells the bounds fix hold in every placement, so the bounds
+            # stay the same with them added
+            bounds = self.line_bounds(line, blocks, length, empty, full)
+            bound_empty, bound_full = bounds_cells(blocks, length, *bounds)
+            empty |= bound_empty
+            full |= bound_full
+            line_mask = (1 << length) - 1
+            if empty | full == line_mask:
+                self.bound_solves += 1
+                return line_mask & ~full, full
+        segments = split_line(blocks, length, empty, full, bounds)
+        if len(segments) == 1 and segments[0][:2] == (0, length):
+            return self.solve_segment(blocks, length, empty, full)
+
+        # Cells outside every segment are empty in all placements
+        self.split_solves += 1
+        can_be_empty = (1 << length) - 1
+        can_be_full = 0
+        for start, end, segment_blocks in segments:
+            segment_mask = (1 << end - start) - 1
+            segment = (
+                segment_blocks,
+                end - start,
+                empty >> start & segment_mask,
+                full >> start & segment_mask
+            )
+            result = quick_line(*segment)
+            if result is None:
+                result = self.solve_segment(*segment)
+            segment_empty, segment_full = result
+            can_be_empty &= ~(segment_mask << start)
+            can_be_empty |= segment_empty << start
+            can_be_full |= segment_full << start
+        return can_be_empty, can_be_full
+
+    def line_bounds(self, line, blocks, length, empty, full):
+        # Earliest and latest block starts for the line in its current
+        # state. A stored leftmost (rightmost) placement that none of the
+        # cells fixed since contradicts is still the leftmost one, so after
+        # a one cell change usually at most one side is searched again, and
+        # then starting from the old starts.
+        is_row, index = line
+        all_bounds = self.row_bounds if is_row else self.column_bounds
+        stored = all_bounds[index]
+        if (
+            stored is None
+            or stored[0] != blocks
+            or stored[1] & ~empty
+            or stored[2] & ~full
         ):
+            earliest = leftmost_starts(blocks, length, empty, full)
+            latest = rightmost_starts(blocks, length, empty, full)
+            left = placement_cells(blocks, earliest)
+            right = placement_cells(blocks, latest)
+        else:
+            _, old_empty, old_full, earliest, latest, left, right = stored
+            if empty == old_empty and full == old_full:
+                return earliest, latest
+            new_empty = empty & ~old_empty
+            new_full = full & ~old_full
+            if new_empty & left or new_full & ~left:
+                earliest = leftmost_starts(
+                    blocks, length, empty, full, earliest
+                )
+                left = placement_cells(blocks, earliest)
+            if new_empty & right or new_full & ~right:
+                latest = rightmost_starts(blocks, length, empty, full, latest)
+                right = placement_cells(blocks, latest)
+        all_bounds[index] = (blocks, empty, full, earliest, latest, left, right)
+        return earliest, latest
+
+    def solve_segment(self, choices, length, empty, full):
+        key = (tuple(choices), length, empty, full)
+        result = self.line_cache.get(key)
+        if result is LineCache.UNSOLVABLE:
             raise UnsolvableStateException('Unsolvable state')
+        if result is not None:
+            return result
 
-        if gather_all_choices:
-            return all_choices
+        line_engine = self.line_engine
+        if line_engine == 'auto':
+            line_engine = select_line_engine(
+                length, len(choices), bin(empty | full).count('1')
+            )
+        self.line_engine_solves[line_engine] += 1
+        try:
+            result = LINE_ENGINES[line_engine](choices, length, empty, full)
+        except UnsolvableStateException:
+            self.line_cache.put(key, LineCache.UNSOLVABLE, length)
+            raise
 
-        return true_mask
+        self.line_cache.put(key, result, length)
+        return result
 
-    def do_pass(self):
-        for y, column in enumerate(self.columns):
-            if len(column) > self.hardness_index:
-                continue
-            if not self.columns_dirty[y]:
-                continue
+    def line_priority(self, is_row, index):
+        # Lower is solved first: the solve cost estimate (length times clue
+        # count) divided by how many crossing cells changed since the last
+        # solve relative to the cells that are still unknown. A complete
+        # line only needs checking against its clue, which is cheapest and
+        # may fail, so it goes first.
+        if is_row:
+            clue = self.rows[index]
+            length = len(self.columns)
+            unknown = self.table.row_unknown[index]
+            changes = self.rows_changes[index]
+        else:
+            clue = self.columns[index]
+            length = len(self.rows)
+            unknown = self.table.column_unknown[index]
+            changes = self.columns_changes[index]
 
-            usability_mask = [self.table[x][y] for x in range(len(self.rows))]
-            mask = self.possibilities(column, len(self.rows), usability_mask)
-            for x, (possible_empty, possible_full) in enumerate(mask):
-                if (
-                        possible_empty and
-                        not possible_full and
-                        self.table[x][y] == 0
-                ):
-                    self.rows_dirty[x] = True
-                    self.table[x][y] = 1
-                    self.changes_table = True
-                if (
-                        not possible_empty and
-                        possible_full and self.table[x][y] == 0
-                ):
-                    self.rows_dirty[x] = True
-                    self.table[x][y] = 2
-                    self.changes_table = True
+        if not unknown:
+            return 0
+        return length * (len(clue) + 1) * (unknown + 1) / (changes + 1)
 
-            self.columns_dirty[y] = False
+    def schedule(self, is_row, index):
+        if is_row:
+            self.rows_dirty[index] = True
+            self.rows_changes[index] += 1
+        else:
+            self.columns_dirty[index] = True
+            self.columns_changes[index] += 1
 
-        for x, row in enumerate(self.rows):
-            if len(row) > self.hardness_index:
-                continue
-            if not self.rows_dirty[x]:
-                continue
+        # Entries are never removed; a line that has been solved since is
+        # skipped when popped, and the entry with the newest (lowest)
+        # priority pops first
+        heapq.heappush(self.queue, (
+            self.line_priority(is_row, index),
+            next(self.queue_counter),
+            is_row,
+            index
+        ))
 
-            usability_mask = [self.table[x][y] for y in
-                              range(len(self.columns))]
-            mask = self.possibilities(row, len(self.columns), usability_mask)
-            for y, (possible_empty, possible_full) in enumerate(mask):
-                if (
-                        possible_empty and
-                        not possible_full and
-                        self.table[x][y] == 0
-                ):
-                    self.columns_dirty[y] = True
-                    self.table[x][y] = 1
-                    self.changes_table = True
-                if (
-                        not possible_empty and
-                        possible_full and
-                        self.table[x][y] == 0
-                ):
-                    self.columns_dirty[y] = True
-                    self.table[x][y] = 2
-                    self.changes_table = True
+    def assign(self, x, y, value, reason=IMPLIED_BY_PATH):
+        self.table.set(x, y, value)
+        if self.record_reasons:
+            self.assigned_at[(x, y)] = len(self.trail)
+            self.reasons.append(reason)
+            if reason is None:
+                self.decision_indices.append(len(self.trail))
+        self.trail.append((x, y))
 
-            self.rows_dirty[x] = False
+    def undo(self, mark):
+        while len(self.trail) > mark:
+            x, y = self.trail.pop()
+            self.table.set(x, y, 0)
+        if self.record_reasons:
+            del self.reasons[mark:]
+            while self.decision_indices and self.decision_indices[-1] >= mark:
+                self.decision_indices.pop()
 
-        if not self.changes_table and self.hardness_index < 20:
-            self.changes_table = True
-            self.hardness_index += 1
+        # Decision points are only taken at a propagation fixpoint, so
+        # nothing was queued there
+        self.queue = []
+        self.rows_dirty = bytearray(len(self.rows))
+        self.columns_dirty = bytearray(len(self.columns))
+        self.rows_changes = array('I', [0]) * len(self.rows)
+        self.columns_changes = array('I', [0]) * len(self.columns)
 
-    def guess_slowly(self):
-        for i in range(len(self.rows_dirty)):
-            self.rows_dirty[i] = True
-        for i in range(len(self.columns_dirty)):
-            self.columns_dirty[i] = True
+    def schedule_all(self):
+        for x in range(len(self.rows)):
+            self.schedule(True, x)
+        for y in range(len(self.columns)):
+            self.schedule(False, y)
+
+    def propagate(self, batched=True):
+        if self.instrumentation is None:
+            self.propagate_queue(batched)
+            return
+
+        start = time.perf_counter()
+        mark = len(self.trail)
+        try:
+            self.propagate_queue(batched)
+        finally:
+            self.instrumentation.propagation(
+                self.depth, len(self.trail) - mark, time.perf_counter() - start
+            )
+
+    def propagate_queue(self, batched=True):
+        # Probing propagates single cell changes, which are not worth a batch
+        # pass, so it asks for the queue even with the numpy engine
+        if batched and self.engine == 'numpy':
+            while any(self.rows_dirty) or any(self.columns_dirty):
+                self.do_batch_pass()
+            self.queue = []
+            return
+
+        while self.queue:
+            _, _, is_row, index = heapq.heappop(self.queue)
+            if is_row and self.rows_dirty[index]:
+                self.solve_row(index)
+            elif not is_row and self.columns_dirty[index]:
+                self.solve_column(index)
 
+    def solve_row(self, x):
+        self.rows_dirty[x] = False
+        self.rows_changes[x] = 0
+
+        empty, full = self.table.row_bits(x)
+        try:
+            if not self.table.row_unknown[x]:
+                # A complete line has nothing left to deduce, it only has
+                # to match its clue
+                check_line(self.rows[x], full)
+                return
+            can_be_empty, can_be_full = self.solve_line(
+                self.rows[x], len(self.columns), empty, full, (True, x)
+            )
+        except UnsolvableStateException as e:
+            e.conflict = self.line_cells(True, x, empty, full)
+            e.line = (True, x)
+            raise
+        reason = (True, x, empty, full)
+        unknown = ~(empty | full)
+        for y in iter_bits(can_be_empty & ~can_be_full & unknown):
+            self.assign(x, y, 1, reason)
+            self.schedule(False, y)
+        for y in iter_bits(can_be_full & ~can_be_empty & unknown):
+            self.assign(x, y, 2, reason)
+            self.schedule(False, y)
+
+    def solve_column(self, y):
+        self.columns_dirty[y] = False
+        self.columns_changes[y] = 0
+
+        empty, full = self.table.column_bits(y)
+        try:
+            if not self.table.column_unknown[y]:
+                # A complete line has nothing left to deduce, it only has
+                # to match its clue
+                check_line(self.columns[y], full)
+                return
+            can_be_empty, can_be_full = self.solve_line(
+                self.columns[y], len(self.rows), empty, full, (False, y)
+            )
+        except UnsolvableStateException as e:
+            e.conflict = self.line_cells(False, y, empty, full)
+            e.line = (False, y)
+            raise
+        reason = (False, y, empty, full)
+        unknown = ~(empty | full)
+        for x in iter_bits(can_be_empty & ~can_be_full & unknown):
+            self.assign(x, y, 1, reason)
+            self.schedule(True, x)
+        for x in iter_bits(can_be_full & ~can_be_empty & unknown):
+            self.assign(x, y, 2, reason)
+            self.schedule(True, x)
+
+    def do_batch_pass(self):
+        cells = self.table.to_array()
+        unknown = cells == 0
+        rows_dirty = numpy.frombuffer(self.rows_dirty, dtype=bool).copy()
+        columns_dirty = numpy.frombuffer(self.columns_dirty, dtype=bool).copy()
+
+        changed = self.solve_batch(
+            cells.T, self.column_blocks, columns_dirty, rows_dirty
+        )
+        changed = self.solve_batch(
+            cells, self.row_blocks, rows_dirty, columns_dirty
+        ) or changed
+
+        if changed:
+            self.table.load_array(cells)
+            for x, y in zip(*[
+                i.tolist() for i in numpy.nonzero(unknown & (cells != 0))
+            ]):
+                if self.record_reasons:
+                    self.assigned_at[(x, y)] = len(self.trail)
+                    self.reasons.append(IMPLIED_BY_PATH)
+                self.trail.append((x, y))
+        self.rows_dirty = bytearray(rows_dirty.tobytes())
+        self.columns_dirty = bytearray(columns_dirty.tobytes())
+
+    def solve_batch(self, cells, clue_blocks, dirty, crossing_dirty):
+        # Solves every dirty line of `cells` (rows of the array, pass the
+        # transpose for columns) in place and marks the crossing lines of
+        # newly fixed cells dirty
+        index = numpy.flatnonzero(dirty)
+        if not len(index):
+            return False
+
+        self.line_solves += len(index)
+        blocks, counts = clue_blocks
+        lines = cells[index]
+        start = time.perf_counter()
+        try:
+            possible_empty, possible_full = batch_line_possibilities(
+                lines, blocks[index], counts[index]
+            )
+        except UnsolvableStateException:
+            if self.instrumentation is not None:
+                self.instrumentation.contradiction('line')
+            raise
+        if self.instrumentation is not None:
+            self.instrumentation.timers['batch_line_solve'] += (
+                time.perf_counter() - start
+            )
+        unknown = lines == 0
+        new_empty = possible_empty & ~possible_full & unknown
+        new_full = possible_full & ~possible_empty & unknown
+        lines[new_empty] = 1
+        lines[new_full] = 2
+        cells[index] = lines
+
+        fixed = new_empty | new_full
+        crossing_dirty |= fixed.any(axis=0)
+        dirty[index] = False
+
+        return bool(fixed.any())
+
+    def choose_branch(self):
+        # Picks the open line with the fewest (but more than one) placements
+        # using counts only; the placements themselves are generated lazily
+        # by branch_choices once a line has been picked
         best = None
 
         for x in range(len(self.rows)):
-            usability_mask = [self.table[x][y] for y in
-                              range(len(self.columns))]
-            choice_options = self.possibilities(
-                self.rows[x], len(self.columns), usability_mask, True
+            if not self.table.row_unknown[x]:
+                continue
+            candidates = count_placements(
+                self.rows[x], len(self.columns), self.table.row(x)
             )
-            if (
-                    len(choice_options) > 1 and
-                    (best is None or len(choice_options) < len(best[2]))
-            ):
-                best = (
-                    x,
-                    None,
-                    choice_options
-                )
+            if candidates > 1 and (best is None or candidates < best[2]):
+                best = (x, None, candidates)
 
         for y in range(len(self.columns)):
-            usability_mask = [self.table[x][y] for x in
-                              range(len(self.rows))]
-            choice_options = self.possibilities(
-                self.columns[y], len(self.rows), usability_mask, True
+            if not self.table.column_unknown[y]:
+                continue
+            candidates = count_placements(
+                self.columns[y], len(self.rows), self.table.column(y)
             )
-            if (
-                    len(choice_options) > 1 and
-                    (best is None or len(choice_options) < len(best[2]))
-            ):
-                best = (
-                    None,
-                    y,
-                    choice_options
-                )
+            if candidates > 1 and (best is None or candidates < best[2]):
+                best = (None, y, candidates)
+
+        return best
+
+    def branch_choices(self, x, y):
+        if x is None:
+            return iter_placements(
+                self.columns[y], len(self.rows), self.table.column(y)
+            )
+        return iter_placements(
+            self.rows[x], len(self.columns), self.table.row(x)
+        )
+
+    def branch(self, x, y, choice_option):
+        new = self.clone()
+        if x is None:
+            for x in range(len(self.rows)):
+                new.table.set(x, y, choice_option[x] + 1)
+        else:
+            for y in range(len(self.columns)):
+                new.table.set(x, y, choice_option[y] + 1)
+        return new
 
-        x, y, choice_options = best
+    def assign_choice(self, x, y, choice_option):
+        # Fixes a guessed line in place; only the lines crossing it get
+        # queued since the guessed line itself is consistent by construction
+        if x is None:
+            for x, value in enumerate(choice_option):
+                if self.table.get(x, y) == 0:
+                    self.assign(x, y, value + 1, None)
+                    self.schedule(True, x)
+        else:
+            for y, value in enumerate(choice_option):
+                if self.table.get(x, y) == 0:
+                    self.assign(x, y, value + 1, None)
+                    self.schedule(False, y)
 
-        for choice_option in choice_options:
+    def line_cells(self, is_row, index, empty, full):
+        if is_row:
+            return [(index, y) for y in iter_bits(empty | full)]
+        return [(x, index) for x in iter_bits(empty | full)]
+
+    def explain(self, cells):
+        # Walks the reasons back from a set of known cells to the guessed
+        # cells that imply them. Cells fixed before the first guess hold in
+        # every branch and are dropped. Returns (x, y, value) literals.
+        if not self.decision_indices:
+            return []
+        first_decision = self.decision_indices[0]
+
+        literals = {}
+        seen = set()
+        stack = list(cells)
+        while stack:
+            cell = stack.pop()
+            if cell in seen:
+                continue
+            seen.add(cell)
+
+            index = self.assigned_at.get(cell, -1)
+            if index < first_decision or self.table.get(*cell) == 0:
+                continue
+            reason = self.reasons[index]
+            if reason is None:
+                literals[cell] = self.table.get(*cell)
+            elif reason == IMPLIED_BY_PATH:
+                for decision in self.decision_indices:
+                    if decision < index:
+                        stack.append(self.trail[decision])
+            else:
+                stack.extend(self.line_cells(*reason))
+
+        return [(x, y, value) for (x, y), value in literals.items()]
+
+    def learn(self, error):
+        if error.conflict is None:
+            literals = self.explain(
+                [self.trail[i] for i in self.decision_indices]
+            )
+        else:
+            literals = self.explain(error.conflict)
+        self.nogoods.add(literals)
+        return literals
+
+    def guess_slowly(self):
+        # Returns True once max_solutions have been found, False when this
+        # subtree held solutions but fewer, and raises when it held none
+        if self.workers > 1:
+            return self.guess_in_parallel()
+
+        if self.instrumentation is None:
+            x, y, candidates = self.choose_branch()
+        else:
+            start = time.perf_counter()
+            x, y, candidates = self.choose_branch()
+            self.instrumentation.timers['choose_branch'] += (
+                time.perf_counter() - start
+            )
+        self.guesses += 1
+        if self.observer is not None:
+            self.observer.on_guess(self, x, y, candidates)
+
+        # If every placement of the guessed line fails, then with learning,
+        # the parts of the branch nogoods off the guessed line plus whatever
+        # implied the line's known cells form a nogood for this node
+        found = False
+        residual = set()
+        for choice_option in self.branch_choices(x, y):
+            mark = len(self.trail)
+            self.depth += 1
+            if self.instrumentation is not None:
+                self.instrumentation.branch(self.depth)
+            try:
+                self.assign_choice(x, y, choice_option)
+                if self.solve_internal():
+                    return True
+                found = True
+            except UnsolvableStateException as e:
+                self.backtracks += 1
+                if self.instrumentation is not None:
+                    self.instrumentation.contradiction('branch')
+                if self.observer is not None:
+                    self.observer.on_backtrack(self, x, y, choice_option)
+                if self.learn_nogoods:
+                    residual.update(
+                        (cell_x, cell_y)
+                        for cell_x, cell_y, _ in self.learn(e)
+                        if cell_x != x and cell_y != y
+                    )
+            finally:
+                self.depth -= 1
+            self.undo(mark)
+
+        if found:
+            return False
+
+        error = UnsolvableStateException('Unsolvable state')
+        if self.learn_nogoods:
             if x is None:
-                new = self.clone()
-                for x in range(len(self.rows)):
-                    new.table[x][y] = choice_option[x] + 1
-                try:
-                    new.solve_internal()
-                except UnsolvableStateException:
-                    pass
-
-                if new.is_solved():
-                    raise SolvedException('Solved')
-                x = None
-
-            if y is None:
-                new = self.clone()
-                for y in range(len(self.columns)):
-                    new.table[x][y] = choice_option[y] + 1
-                try:
-                    new.solve_internal()
-                except UnsolvableStateException:
-                    pass
-
-                if new.is_solved():
-                    raise SolvedException('Solved')
-                y = None
+                line_bits = self.table.column_bits(y)
+            else:
+                line_bits = self.table.row_bits(x)
+            error.conflict = list(residual) + self.line_cells(
+                x is not None, y if x is None else x, *line_bits
+            )
+        raise error
+
+    def guess_in_parallel(self):
+        # Expands the search tree parallel_depth levels deep here, then
+        # solves the remaining branches on a process pool. The branches are
+        # disjoint, so their solutions add up. As soon as max_solutions have
+        # come back, branches not started yet are cancelled and the running
+        # ones stop at their next search node.
+        frontier = [self]
+        for depth in range(self.parallel_depth):
+            next_frontier = []
+            for node in frontier:
+                x, y, candidates = node.choose_branch()
+                self.guesses += 1
+                if self.observer is not None:
+                    self.observer.on_guess(node, x, y, candidates)
+
+                for choice_option in node.branch_choices(x, y):
+                    new = node.branch(x, y, choice_option)
+                    self.nodes += 1
+                    if self.instrumentation is not None:
+                        self.instrumentation.branch(depth + 1)
+                    try:
+                        new.propagate()
+                    except UnsolvableStateException:
+                        self.backtracks += 1
+                        if self.observer is not None:
+                            self.observer.on_backtrack(
+                                node, x, y, choice_option
+                            )
+                        continue
+
+                    if new.is_solved():
+                        if self.record_solution(new):
+                            return True
+                        continue
+                    next_frontier.append(new)
+            frontier = next_frontier
+
+        remaining = self.max_solutions - len(self.solutions)
+        tasks = [
+            (
+                node.rows,
+                node.columns,
+                node.table,
+                node.engine,
+                node.line_engine,
+                node.probe_budget,
+                node.learn_nogoods,
+                node.nogoods.max_nogoods,
+                self.instrumentation is not None,
+                remaining
+            )
+            for node in frontier
+        ]
+        if tasks:
+            stop = multiprocessing.RawValue('b', 0)
+            executor = ProcessPoolExecutor(
+                max_workers=min(self.workers, len(tasks)),
+                initializer=set_branch_stop,
+                initargs=(stop,)
+            )
+            try:
+                futures = [executor.submit(solve_branch, task) for task in tasks]
+                for future in as_completed(futures):
+                    tables, stats, instrumentation = future.result()
+                    self.nodes += stats['nodes']
+                    self.guesses += stats['guesses']
+                    self.backtracks += stats['backtracks']
+                    self.line_solves += stats['line_solves']
+                    self.quick_solves += stats['quick_solves']
+                    self.bound_solves += stats['bound_solves']
+                    self.split_solves += stats['split_solves']
+                    for name, solves in stats['line_engines'].items():
+                        self.line_engine_solves[name] += solves
+                    if instrumentation is not None:
+                        self.instrumentation.merge(
+                            instrumentation, self.parallel_depth
+                        )
+                    for table in tables:
+                        solved = self.clone()
+                        solved.table = table
+                        if self.record_solution(solved):
+                            return True
+            finally:
+                stop.value = 1
+                executor.shutdown(cancel_futures=True)
+
+        if self.solutions:
+            return False
+        raise UnsolvableStateException('Unsolvable state')
+
+    def probe_candidates(self):
+        # Unknown cells whose row and column have the fewest unknown cells
+        # left come first; those are the most constrained and the most
+        # likely to fail quickly on one side
+        row_unknown = self.table.row_unknown
+        column_unknown = self.table.column_unknown
+        full_row = (1 << len(self.columns)) - 1
+
+        candidates = []
+        for x in range(len(self.rows)):
+            if not row_unknown[x]:
+                continue
+            empty, full = self.table.row_bits(x)
+            for y in iter_bits(~(empty | full) & full_row):
+                candidates.append((row_unknown[x] + column_unknown[y], x, y))
+        candidates.sort()
+        return [(x, y) for _, x, y in candidates[:self.probe_budget]]
+
+    def probe_cell(self, x, y, value):
+        # Returns the cells (with values) fixed by propagating one value for
+        # the cell, or None when it leads to a contradiction
+        mark = len(self.trail)
+        try:
+            self.assign(x, y, value)
+            self.schedule(True, x)
+            self.schedule(False, y)
+            self.propagate(batched=False)
+            fixed = {
+                cell: self.table.get(*cell) for cell in self.trail[mark:]
+            }
+        except UnsolvableStateException:
+            if self.instrumentation is not None:
+                self.instrumentation.contradiction('probe')
+            fixed = None
+        self.undo(mark)
+        return fixed
+
+    def probe(self):
+        # Failed literal probing: a value that propagates into a
+        # contradiction fixes the cell to the other value, and cells that
+        # end up with the same value both ways are fixed as well. Returns
+        # whether anything was fixed.
+        if not self.probe_budget:
+            return False
+
+        progress = False
+        for x, y in self.probe_candidates():
+            if self.table.get(x, y) != 0:
+                continue
+
+            if_empty = self.probe_cell(x, y, 1)
+            if_full = self.probe_cell(x, y, 2)
+            if if_empty is None and if_full is None:
+                raise UnsolvableStateException('Unsolvable state')
+
+            if if_empty is None:
+                fixed = {(x, y): 2}
+            elif if_full is None:
+                fixed = {(x, y): 1}
+            else:
+                fixed = {
+                    cell: value
+                    for cell, value in if_empty.items()
+                    if if_full.get(cell) == value
+                }
+            if not fixed:
+                continue
+
+            for (cell_x, cell_y), value in fixed.items():
+                self.assign(cell_x, cell_y, value)
+                self.schedule(True, cell_x)
+                self.schedule(False, cell_y)
+            # undo() expects a fixpoint, so propagate before the next probe
+            self.propagate(batched=False)
+            progress = True
+
+            if self.is_solved():
+                break
+
+        return progress
+
+    def record_solution(self, solver):
+        # Returns whether the search should stop
+        self.solutions.append(solver.table.filled())
+        if self.observer is not None:
+            self.observer.on_solved(solver)
+        return len(self.solutions) >= self.max_solutions
 
     def solve_internal(self):
-        self.print_table()
-        for i in range(100):
-            self.changes_table = False
-            self.do_pass()
-            if not self.changes_table:
-                if not self.is_solved():
-                    self.guess_slowly()
+        if self.should_stop is not None and self.should_stop():
+            raise SearchStopped('Stopped')
+        self.nodes += 1
+        self.propagate()
+        if self.instrumentation is None:
+            while not self.is_solved() and self.probe():
+                pass
+        else:
+            start = time.perf_counter()
+            while not self.is_solved() and self.probe():
+                pass
+            self.instrumentation.timers['probe'] += time.perf_counter() - start
+        if self.learn_nogoods and not self.is_solved():
+            nogood = self.nogoods.match(self.table)
+            if nogood is not None:
+                if self.instrumentation is not None:
+                    self.instrumentation.contradiction('nogood')
+                error = UnsolvableStateException('Nogood')
+                error.conflict = [(x, y) for x, y, _ in nogood]
+                raise error
+        if self.observer is not None:
+            self.observer.on_pass(self)
+
+        if self.is_solved():
+            return self.record_solution(self)
+        return self.guess_slowly()
+
+    def stats(self):
+        stats = {
+            'nodes': self.nodes,
+            'guesses': self.guesses,
+            'backtracks': self.backtracks,
+            'line_solves': self.line_solves,
+            'quick_solves': self.quick_solves,
+            'bound_solves': self.bound_solves,
+            'split_solves': self.split_solves,
+            'line_engines': dict(self.line_engine_solves),
+            'line_cache': self.line_cache.stats(),
+        }
+        if self.learn_nogoods:
+            stats['nogoods'] = self.nogoods.stats()
+        if self.instrumentation is not None:
+            stats['instrumentation'] = self.instrumentation.to_dict()
+        return stats
+
+    def solve(self, max_solutions=1):
+        # Searches until max_solutions solutions are found (pass 2 to check
+        # uniqueness) or the search space is exhausted
+        self.max_solutions = max_solutions
+        self.solutions = []
+        start = time.perf_counter()
+
+        # A puzzle finished without guessing has exactly one solution
+        status = None
+        try:
+            complete = not self.solve_internal() or self.guesses == 0
+        except UnsolvableStateException:
+            complete = True
+        except SearchStopped:
+            complete = False
+            status = 'stopped'
+
+        stats = self.stats()
+        stats['time'] = time.perf_counter() - start
+        return SolveResult(
+            status or ('solved' if self.solutions else 'unsolvable'),
+            self.solutions,
+            complete,
+            stats
+        )
+
+
+class SolveSession:
+    # Keeps a puzzle's root propagation state across clue edits, for
+    # editors that re-solve after every change. Every cell deduced at the
+    # root remembers the line that fixed it, when, and which of that line's
+    # cells it rests on. An edit retracts the cells the edited line fixed;
+    # a cell resting on a retracted one is re-checked against the cells of
+    # its line that are still known and were fixed before it, and only
+    # retracted itself when those no longer force it. Search below the root
+    # runs on the session's solver and is undone back to the root afterwards.
+    def __init__(
+        self,
+        rows,
+        columns,
+        line_cache=None,
+        engine='python',
+        probe_budget=16,
+        learn_nogoods=False
+    ):
+        self.solver = Solver(
+            rows=[list(clue) for clue in rows],
+            columns=[list(clue) for clue in columns],
+            line_cache=line_cache,
+            engine=engine,
+            headless=True,
+            probe_budget=probe_budget,
+            learn_nogoods=learn_nogoods
+        )
+        self.solver.record_reasons = True
+
+        # cell -> (line, stamp) for every deduced cell, with one stamp per
+        # line solve, and line -> {cell: support} for the cells each line
+        # fixed, where support is the bitmask of the line's cells (all
+        # stamped earlier) that the deduction rests on besides the clue.
+        self.deductions = {}
+        self.fixed_by = defaultdict(dict)
+        self.stamps = count()
+
+        self.failed_line = None
+        self.edits = 0
+        self.retracted = 0
+
+    @property
+    def rows(self):
+        return self.solver.rows
+
+    @property
+    def columns(self):
+        return self.solver.columns
+
+    def set_row(self, x, clue):
+        self.edit(True, x, clue)
+
+    def set_column(self, y, clue):
+        self.edit(False, y, clue)
+
+    def edit(self, is_row, index, clue):
+        solver = self.solver
+        clues = solver.rows if is_row else solver.columns
+        clue = list(clue)
+        if clues[index] == clue:
+            return
+        clues[index] = clue
+        self.edits += 1
+        if solver.engine == 'numpy':
+            solver.row_blocks = clue_blocks_array(solver.rows)
+            solver.column_blocks = clue_blocks_array(solver.columns)
+
+        for x, y in self.retract((is_row, index)):
+            solver.schedule(True, x)
+            solver.schedule(False, y)
+        solver.schedule(is_row, index)
+
+    def retract(self, line):
+        # Clears the cells fixed by line, then re-checks the cells resting
+        # on a cleared one, oldest line solve first, clearing those that
+        # their line no longer forces. Returns the cleared cells.
+        table = self.solver.table
+        retracted = []
+        # (stamp, line) -> cells of that line solve to re-check, with the
+        # same keys in a heap
+        suspects = {}
+        queue = []
+        for cell in list(self.fixed_by[line]):
+            self.clear(cell, retracted, suspects, queue)
+
+        while queue:
+            key = heapq.heappop(queue)
+            stamp, (is_row, index) = key
+            cells = [
+                cell for cell in suspects.pop(key) if cell in self.deductions
+            ]
+            if not cells:
+                continue
+            support = self.line_support(is_row, index, stamp)
+            if is_row:
+                empty, full = table.row_bits(index)
+                clue, length = self.solver.rows[index], table.width
+            else:
+                empty, full = table.column_bits(index)
+                clue, length = self.solver.columns[index], table.height
+            can_be_empty, can_be_full = automaton_line(
+                [block for block in clue if block],
+                length,
+                empty & support,
+                full & support
+            )
+            forced_empty = can_be_empty & ~can_be_full
+            forced_full = can_be_full & ~can_be_empty
+            fixed = self.fixed_by[(is_row, index)]
+            for cell in cells:
+                position = cell[1] if is_row else cell[0]
+                if empty >> position & 1:
+                    forced = forced_empty >> position & 1
                 else:
-                    self.print_table()
-                    raise SolvedException('Solved')
-                break
-            self.print_table()
+                    forced = forced_full >> position & 1
+                if forced:
+                    fixed[cell] = support
+                else:
+                    self.clear(cell, retracted, suspects, queue)
+
+        self.retracted += len(retracted)
+        return retracted
+
+    def clear(self, cell, retracted, suspects, queue):
+        # Unsets a deduced cell and queues the line solves resting on it
+        fixing_line, _ = self.deductions.pop(cell)
+        del self.fixed_by[fixing_line][cell]
+        self.solver.table.set(cell[0], cell[1], 0)
+        retracted.append(cell)
+        x, y = cell
+        for crossing, position in (((True, x), y), ((False, y), x)):
+            for dependent, support in self.fixed_by[crossing].items():
+                if support >> position & 1:
+                    key = (self.deductions[dependent][1], crossing)
+                    if key not in suspects:
+                        suspects[key] = set()
+                        heapq.heappush(queue, key)
+                    suspects[key].add(dependent)
+
+    def line_support(self, is_row, index, stamp):
+        # The line's known cells that were fixed before stamp
+        table = self.solver.table
+        if is_row:
+            empty, full = table.row_bits(index)
+        else:
+            empty, full = table.column_bits(index)
+        known = empty | full
+        support = 0
+        while known:
+            bit = known & -known
+            known ^= bit
+            position = bit.bit_length() - 1
+            cell = (index, position) if is_row else (position, index)
+            if self.deductions[cell][1] < stamp:
+                support |= bit
+        return support
 
-    def solve(self):
+    def record_deductions(self):
+        # Cells fixed by one line solve share their reason tuple
+        solver = self.solver
+        reason = stamp = None
+        for cell, cell_reason in zip(solver.trail, solver.reasons):
+            if cell_reason is not reason:
+                reason = cell_reason
+                stamp = next(self.stamps)
+            is_row, index, empty, full = reason
+            line = (is_row, index)
+            self.deductions[cell] = (line, stamp)
+            self.fixed_by[line][cell] = empty | full
+        solver.trail = []
+        solver.reasons = []
+        solver.assigned_at = {}
+
+    def propagate(self):
+        # Line by line so that every deduction has a line as its reason
+        solver = self.solver
+        if self.failed_line is not None:
+            solver.schedule(*self.failed_line)
+            self.failed_line = None
         try:
-            self.solve_internal()
-        except SolvedException:
-            print('')
-            print(' ' + '*' * 30)
-            print(' * SOLVED :))))))))')
-            print(' ' +  '*' * 30)
-
-
-# solver = Solver("2/1,2/1,2/3/4", "1/5/2/4/2,1")
-# solver.solve()
-#
-# solver = Solver("3/2,1/3,2/2,2/6/1,5/6/1/2", "1,2/3,1/1,5/7,1/5/3/4/3")
-# solver.solve()
-#
-# solver = Solver("2/2/2/4/2/2", "0/1/6/6/1/0/0")
-# solver.solve()
-
-# solver = Solver(
-#     "8,7,5,7/5,4,3,3/3,3,2,3/4,3,2,2/3,3,2,2/3,4,2,2/4,5,2/3,5,1/4,3,2/3,4,2/4,4,2/3,6,2/3,2,3,1/4,3,4,2/3,2,3,2/6,5/4,5/3,3/3,3/1,1",
-#     "1/1/2/4/7/9/2,8/1,8/8/1,9/2,7/3,4/6,4/8,5/1,11/1,7/8/1,4,8/6,8/4,7/2,4/1,4/5/1,4/1,5/7/5/3/1/1"
-# )
-# solver.solve()
-
-# solver = Solver(
-#     "1,1/1,1/3/4/4/2,6/2,2,2/4,2,2/3,1,2,1/1,2,2,1,1/1,1,2,1/2,4,1/2,1,2/7,4",
-#     "1,2/4/10/8,2/1,3,2/2,2,1/2,1,1/1,2,1,1/1,1,1,1,1/1,2,2,1/1,3,1/2,1/2,1,1/4,2/2/1"
-# )
-# solver.solve()
-#
-# solver = Solver(
-#     "8/13/17/4,14/3,3,3/3,2,10,2/2,2,11,2/2,2,12,1/2,2,12,1/3,1,4,4,1/3,2,4,4,1/2,2,12,1/3,2,11,1/6,9,1/11,7/10,5/16/7,5/4,5/4,5",
-#     "3/8/4,5/3,3/3,5,3/2,3,6/3,2,5/2,2,4/4,3/5,4/4,15/4,15/4,15/4,15/4,4,3,2/4,4,4,2/4,4,6/3,4,7/3,15/2,8,6/3,7,6/2,5,1,4/2,1,2/2,1/6"
-# )
-# solver.solve()
-#
-# solver = Solver(
-#     "4/6/2,3/2/3,1,3/1,5,1/1,1/1,2,1/1,1,1/1,1/1,1/1,1/1,1/2,1,2/3,3",
-#     "5/1,2/1,1,1/1,2,2/1,2,1/2,1,1/1,3,1/2,1,1/3,2,1/3,1,2/3,1,1/1,1,2/5"
-# )
-# solver.solve()
-#
-# solver = Solver(
-#     "1,3/2,2/2,3/2,1,2/1,3/2,3/2,4/3,4/4,5/5,5/3,6/2,1,1/12/8/15",
-#     "1,1/2,1,1/2,1,2,1/2,2,1,1/4,3/6,3/12/2,3/15/1,9,3/1,7,3/5,3/3,1,1/1,1,1/1"
-# )
-# solver.solve()
-
-# solver = Solver(
-#     input_json={
-#         "columns": [
-#             [1],
-#             [0],
-#             [1],
-#             [0],
-#             [1],
-#             [0],
-#             [1],
-#             [0],
-#             [1],
-#             [0],
-#             [1]
-#         ],
-#         "rows": [
-#             [1, 1, 1],
-#             [0],
-#             [1, 1, 1]
-#         ]
-#     }
-# )
-# solver.solve()
-
-# solver = Solver(
-#     input_json={
-#         "columns": [
-#             [4],
-#             [9],
-#             [11],
-#             [13],
-#             [4, 5],
-#             [3, 4],
-#             [3, 4, 3],
-#             [3, 4, 6],
-#             [8, 4, 8],
-#             [6, 5, 10],
-#             [2, 5, 4, 3],
-#             [9, 5, 3, 3],
-#             [11, 5, 3, 4],
-#             [12, 5, 4, 4],
-#             [18, 2, 5, 3],
-#             [4, 16, 12, 1],
-#             [3, 17, 12],
-#             [4, 18, 3, 5],
-#             [3, 19, 4, 2],
-#             [6, 10, 9, 1],
-#             [7, 10, 7, 2],
-#             [2, 9, 4, 2],
-#             [14, 2],
-#             [3, 17, 3],
-#             [4, 25, 3],
-#             [8, 27, 5],
-#             [45],
-#             [27, 12],
-#             [25, 6],
-#             [26],
-#             [26],
-#             [27],
-#             [34],
-#             [36],
-#             [8, 27],
-#             [6, 27],
-#             [2, 12, 9],
-#             [12, 6],
-#             [14, 5],
-#             [15, 5],
-#             [15, 4],
-#             [3, 4, 11, 4],
-#             [7, 4, 10, 4, 3],
-#             [3, 10, 5, 5, 3, 4],
-#             [2, 8, 5, 4, 3, 5],
-#             [1, 6, 4, 4, 1, 3, 2],
-#             [5, 6, 3, 2],
-#             [5, 7, 4, 3],
-#             [13, 8, 8],
-#             [13, 5, 3, 5],
-#             [13, 3, 3],
-#             [13, 2, 3],
-#             [3, 2, 3],
-#             [3, 3, 3],
-#             [3, 4, 5],
-#             [3, 2, 9],
-#             [4, 2, 6],
-#             [8, 2],
-#             [4]
-#         ],
-#         "rows": [
-#             [1],
-#             [1, 2],
-#             [2, 7],
-#             [3, 10],
-#             [3, 11, 4],
-#             [2, 12, 3],
-#             [4, 13, 3],
-#             [5, 13, 2],
-#             [5, 12, 3],
-#             [6, 11, 3, 4],
-#             [5, 10, 4, 6],
-#             [4, 8, 3, 8],
-#             [4, 11, 3, 4, 3],
-#             [4, 12, 3, 4, 2],
-#             [4, 13, 4, 4, 3],
-#             [5, 4, 13, 5, 4, 2],
-#             [7, 5, 13, 7, 4, 2],
-#             [8, 7, 20, 4, 2],
-#             [4, 34, 4, 3],
-#             [3, 3, 29, 4, 3],
-#             [3, 2, 28, 5],
-#             [4, 2, 28, 6],
-#             [4, 1, 38],
-#             [4, 39],
-#             [5, 40],
-#             [46, 7],
-#             [13, 30, 7],
-#             [11, 6, 6, 12, 3, 4],
-#             [8, 5, 6, 13, 2, 3],
-#             [5, 5, 4, 7, 3, 3],
-#             [4, 5, 4, 7, 2, 4],
-#             [4, 5, 4, 8, 3],
-#             [4, 4, 5, 14],
-#             [2, 4, 4, 5, 11],
-#             [7, 4, 4, 5, 9],
-#             [8, 4, 4, 6, 2],
-#             [5, 4, 4, 4, 7, 2],
-#             [4, 3, 3, 3, 10],
-#             [4, 3, 4, 3, 14],
-#             [4, 6, 3, 14],
-#             [4, 6, 3, 14],
-#             [12, 3, 3],
-#             [9, 3, 3, 2],
-#             [9, 3, 3, 2],
-#             [2, 3, 4, 3, 3],
-#             [3, 3, 6],
-#             [2, 4, 5],
-#             [3, 4],
-#             [1, 8],
-#             [4]
-#         ]
-#     }
-# )
-# solver.solve()
-
-# solver = Solver(
-#     input_json={
-#         "columns": [
-#             [7, 1, 1, 5, 7],
-#             [1, 1, 3, 1, 1, 1],
-#             [1, 3, 1, 6, 2, 1, 3, 1],
-#             [1, 3, 1, 1, 2, 1, 1, 3, 1],
-#             [1, 3, 1, 1, 2, 1, 1, 3, 1],
-#             [1, 1, 1, 1, 1, 1, 1],
-#             [7, 1, 1, 1, 1, 1, 7],
-#             [2, 1, 2],
-#             [1, 1, 2, 3, 1, 2, 5],
-#             [3, 2, 2, 2, 3, 3],
-#             [2, 1, 2, 2, 1, 2, 1, 2],
-#             [1, 2, 3, 3],
-#             [1, 2, 2, 1, 2, 1, 1, 2, 1, 1],
-#             [1, 3, 2, 1, 1, 1, 1, 1],
-#             [1, 2, 4, 1, 3, 1, 4],
-#             [2, 1, 1, 3, 1, 1, 1, 1],
-#             [3, 3, 2, 1, 6, 1],
-#             [1, 3, 1, 1, 2, 2],
-#             [7, 1, 1, 1, 2],
-#             [1, 1, 2, 1, 4, 1],
-#             [1, 3, 1, 3, 8, 1],
-#             [1, 3, 1, 1, 1, 2, 1],
-#             [1, 3, 1, 2, 2, 1, 1, 1],
-#             [1, 1, 1, 1, 1, 6, 1],
-#             [7, 2, 5, 5]
-#         ],
-#         "rows": [
-#             [7, 1, 1, 1, 1, 7],
-#             [1, 1, 1, 1, 1, 2, 1, 1],
-#             [1, 3, 1, 1, 3, 1, 3, 1],
-#             [1, 3, 1, 3, 3, 1, 3, 1],
-#             [1, 3, 1, 1, 1, 1, 3, 1],
-#             [1, 1, 2, 6, 1, 1],
-#             [7, 1, 1, 1, 1, 1, 7],
-#             [3, 3],
-#             [5, 4, 1, 2, 1, 1, 1, 1],
-#             [2, 1, 2, 1, 2, 1, 1, 1],
-#             [4, 1, 1, 1, 4, 1, 3],
-#             [4, 1, 1, 1, 2, 1],
-#             [3, 1, 2, 2, 4, 2, 3],
-#             [1, 1, 1, 1, 1, 1, 1, 1],
-#             [1, 1, 1, 1, 5, 1, 2, 2],
-#             [1, 1, 1, 1, 1, 2, 1],
-#             [1, 1, 1, 2, 3, 12],
-#             [1, 1, 1, 1, 2, 2],
-#             [7, 2, 1, 1, 1, 1, 2],
-#             [1, 1, 2, 1, 1, 1, 1, 1],
-#             [1, 3, 1, 2, 9, 3],
-#             [1, 3, 1, 1, 1, 3, 2, 2],
-#             [1, 3, 1, 2, 3, 1, 1],
-#             [1, 1, 4, 3, 1, 1],
-#             [7, 5, 1, 2]
-#         ]
-#     }
-# )
-# solver.solve()
-
-solver = Solver(
-    input_json={
-        "columns": [
-            [43, 43],
-            [38, 38],
-            [34, 14, 34],
-            [31, 14, 31],
-            [29, 11, 29],
-            [27, 12, 27],
-            [25, 13, 25],
-            [24, 14, 24],
-            [22, 14, 22],
-            [21, 3, 3, 2, 21],
-            [19, 19],
-            [18, 18],
-            [17, 17],
-            [16, 16],
-            [15, 2, 15],
-            [14, 3, 14],
-            [13, 4, 13],
-            [12, 3, 12],
-            [11, 2, 2, 11],
-            [10, 5, 2, 10],
-            [10, 4, 6, 10],
-            [9, 5, 12, 9],
-            [8, 4, 16, 8],
-            [8, 3, 18, 8],
-            [7, 3, 20, 7],
-            [6, 2, 20, 6],
-            [6, 1, 21, 6],
-            [5, 2, 23, 5],
-            [5, 2, 2, 24, 5],
-            [4, 2, 3, 1, 24, 4],
-            [4, 3, 2, 4, 25, 4],
-            [3, 3, 3, 5, 25, 4],
-            [3, 3, 2, 5, 25, 3],
-            [3, 2, 3, 5, 25, 3],
-            [2, 3, 3, 2, 4, 25, 2],
-            [2, 2, 4, 2, 1, 2, 4, 27, 2],
-            [2, 2, 4, 1, 2, 6, 27, 2],
-            [2, 2, 5, 1, 5, 5, 27, 2],
-            [1, 8, 1, 7, 33, 1],
-            [1, 7, 6, 34, 1],
-            [1, 6, 7, 2, 36, 2, 1],
-            [1, 6, 7, 36, 5, 1],
-            [1, 6, 2, 8, 1, 44, 1],
-            [3, 2, 9, 2, 2, 46],
-            [2, 4, 8, 2, 1, 46],
-            [2, 6, 8, 2, 47],
-            [6, 9, 49],
-            [3, 1, 12, 50],
-            [1, 4, 13, 50],
-            [2, 3, 2, 15, 50],
-            [19, 50],
-            [21, 49],
-            [19, 3, 48],
-            [16, 4, 48],
-            [1, 12, 4, 47],
-            [15, 5, 46],
-            [1, 16, 5, 45],
-            [1, 1, 3, 14, 3, 4, 21, 16, 1],
-            [1, 1, 16, 11, 29, 4, 2, 1],
-            [1, 18, 12, 32, 1],
-            [1, 1, 1, 33, 30, 1],
-            [1, 41, 28, 1],
-            [2, 42, 16, 8, 2],
-            [2, 23, 21, 14, 2],
-            [2, 22, 21, 12, 1, 2],
-            [2, 21, 1, 34, 1, 3, 2],
-            [3, 23, 20, 8, 6, 3],
-            [3, 24, 6, 13, 7, 6, 3],
-            [3, 25, 6, 11, 6, 5, 4],
-            [4, 34, 10, 6, 4, 4],
-            [4, 34, 8, 4, 2, 4],
-            [5, 34, 8, 1, 5],
-            [5, 33, 7, 5],
-            [6, 33, 7, 6],
-            [6, 32, 5, 6],
-            [7, 32, 2, 7],
-            [8, 31, 8],
-            [8, 30, 8],
-            [9, 30, 9],
-            [10, 29, 10],
-            [10, 28, 10],
-            [11, 28, 11],
-            [12, 28, 12],
-            [13, 27, 13],
-            [14, 28, 14],
-            [15, 30, 15],
-            [16, 31, 16],
-            [17, 31, 17],
-            [18, 30, 18],
-            [19, 20, 2, 19],
-            [21, 15, 1, 21],
-            [22, 13, 22],
-            [24, 12, 24],
-            [25, 12, 1, 25],
-            [27, 10, 27],
-            [29, 10, 2, 29],
-            [31, 6, 9, 32],
-            [34, 5, 34],
-            [38, 38],
-            [43, 43]
-        ],
-        "rows": [
-            [43, 43],
-            [38, 38],
-            [34, 1, 34],
-            [31, 6, 31],
-            [29, 10, 2, 29],
-            [27, 6, 8, 2, 1, 5, 27],
-            [25, 5, 9, 10, 25],
-            [24, 4, 8, 1, 11, 24],
-            [22, 4, 9, 2, 1, 13, 22],
-            [21, 5, 9, 2, 16, 21],
-            [19, 4, 10, 1, 16, 19],
-            [18, 4, 4, 20, 18],
-            [17, 4, 2, 1, 6, 1, 22, 17],
-            [16, 4, 3, 34, 16],
-            [15, 5, 8, 27, 15],
-            [14, 6, 5, 33, 14],
-            [13, 3, 1, 4, 35, 13],
-            [12, 3, 2, 6, 36, 12],
-            [11, 3, 1, 2, 1, 3, 36, 11],
-            [10, 1, 1, 2, 38, 10],
-            [10, 2, 1, 1, 1, 38, 10],
-            [9, 1, 2, 2, 42, 9],
-            [8, 3, 49, 8],
-            [8, 52, 8],
-            [7, 56, 7],
-            [6, 56, 6],
-            [6, 28, 26, 6],
-            [5, 19, 2, 5, 27, 5],
-            [5, 12, 9, 5, 26, 5],
-            [4, 7, 2, 8, 5, 25, 4],
-            [4, 6, 1, 2, 6, 2, 6, 26, 4],
-            [3, 6, 1, 2, 3, 1, 13, 25, 3],
-            [3, 4, 1, 3, 15, 25, 3],
-            [3, 3, 2, 43, 3],
-            [2, 11, 1, 5, 37, 2],
-            [2, 13, 37, 2],
-            [2, 14, 37, 2],
-            [2, 16, 37, 2],
-            [1, 18, 4, 39, 1],
-            [1, 43, 21, 5, 1],
-            [1, 45, 20, 4, 1],
-            [1, 47, 9, 4, 1],
-            [1, 35, 11, 2, 8, 3, 1],
-            [1, 37, 16, 5, 2],
-            [1, 38, 15, 5, 2],
-            [1, 38, 14, 4, 1, 1],
-            [1, 39, 13, 4, 1],
-            [1, 40, 13, 4, 2],
-            [1, 41, 11, 3, 1],
-            [2, 43, 8, 3, 1],
-            [2, 43, 7, 2, 2],
-            [2, 42, 5, 3, 2],
-            [2, 44, 3, 2, 1],
-            [2, 45, 2],
-            [2, 45, 3, 2],
-            [3, 49, 2],
-            [3, 49, 1],
-            [1, 3, 48, 1, 1],
-            [1, 4, 46, 1],
-            [1, 5, 35, 1],
-            [1, 5, 34, 1],
-            [1, 6, 30, 1],
-            [2, 7, 29, 2],
-            [2, 6, 28, 2],
-            [2, 6, 19, 7, 2],
-            [2, 5, 19, 6, 2],
-            [3, 4, 19, 5, 3],
-            [3, 4, 24, 3],
-            [3, 4, 22, 4],
-            [4, 3, 23, 4],
-            [4, 4, 22, 4],
-            [5, 3, 22, 5],
-            [5, 3, 22, 5],
-            [6, 1, 16, 4, 2, 6],
-            [6, 2, 17, 4, 3, 6],
-            [7, 1, 22, 3, 7],
-            [8, 23, 4, 8],
-            [8, 21, 4, 8],
-            [9, 18, 3, 9],
-            [10, 16, 3, 10],
-            [10, 17, 4, 10],
-            [11, 16, 2, 11],
-            [12, 15, 12],
-            [13, 14, 13],
-            [14, 12, 14],
-            [15, 10, 15],
-            [16, 8, 16],
-            [17, 6, 17],
-            [18, 18],
-            [19, 19],
-            [21, 21],
-            [22, 22],
-            [24, 24],
-            [25, 25],
-            [27, 27],
-            [29, 29],
-            [32, 32],
-            [34, 34],
-            [38, 38],
-            [43, 43]
-        ]
-    }
+            solver.propagate(batched=False)
+        except UnsolvableStateException as e:
+            self.failed_line = e.line
+            raise
+        finally:
+            self.record_deductions()
+
+    def solve(self, max_solutions=1):
+        start = time.perf_counter()
+        solver = self.solver
+        solver.reset_stats()
+        try:
+            self.propagate()
+        except UnsolvableStateException:
+            root_line_solves = solver.line_solves
+            result = SolveResult('unsolvable', [], True, {})
+        else:
+            # The root is a fixpoint, so the search has nothing to propagate
+            # before it probes and guesses. Nogoods learned under the
+            # current clues may not hold after the next edit.
+            root_line_solves = solver.line_solves
+            solver.reset_stats()
+            try:
+                result = solver.solve(max_solutions)
+            finally:
+                solver.undo(0)
+                solver.assigned_at = {}
+                solver.nogoods = NogoodStore(solver.nogoods.max_nogoods)
+                solver.solutions = []
+
+        result.stats['session'] = {
+            'edits': self.edits,
+            'retracted': self.retracted,
+            'root_line_solves': root_line_solves,
+            'root_cells': len(self.deductions),
+        }
+        result.stats['time'] = time.perf_counter() - start
+        return result
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'puzzles.jsonl')
+
+
+def load_corpus(path=CORPUS_PATH):
+    # The bundled puzzles, one {"id", "rows", "columns"} object per line
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+CLUE_TOKEN = re.compile(r'\d+|/')
+JSON_TOKEN = re.compile(
+    r'"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|'
+    r'true|false|null|[\[\]{}:,]|\S'
 )
-solver.solve()
+
+
+def iter_puzzles(stream):
+    # Reads puzzles one at a time from a text stream holding any number of
+    # {"rows", "columns"} JSON objects (JSON lines or pretty printed), or of
+    # line pairs in the string form: a line of row clues followed by a line
+    # of column clues, e.g. "2/1,2/3". Clues go straight into Clues arrays
+    # without the nested lists json.loads would build.
+    lines = iter(stream)
+    for line in lines:
+        if line.strip():
+            break
+    else:
+        return
+
+    lines = chain([line], lines)
+    if line.lstrip().startswith('{'):
+        yield from iter_json_puzzles(lines)
+    else:
+        yield from iter_text_puzzles(lines)
+
+
+def iter_text_puzzles(lines):
+    row_line = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if row_line is None:
+            row_line = line
+        else:
+            yield {
+                'rows': Clues.from_text(row_line),
+                'columns': Clues.from_text(line),
+            }
+            row_line = None
+    if row_line is not None:
+        raise ValueError(
+            'Expected a line of row clues and a line of column clues'
+        )
+
+
+def iter_json_puzzles(lines):
+    # A small tokenizer instead of json.loads. JSON tokens never span lines,
+    # so the input is read a line at a time. Only the top level members of
+    # each object are kept; rows and columns become Clues.
+    puzzle = None
+    nesting = []
+    key = None
+    expect_key = False
+    for line in lines:
+        for match in JSON_TOKEN.finditer(line):
+            token = match.group()
+            depth = len(nesting)
+            if token == '{':
+                nesting.append(token)
+                if depth == 0:
+                    puzzle = {}
+                    expect_key = True
+            elif token == '[':
+                nesting.append(token)
+                if depth == 1 and key in ('rows', 'columns'):
+                    puzzle[key] = Clues()
+            elif token in ']}':
+                opening = '[' if token == ']' else '{'
+                if not nesting or nesting.pop() != opening:
+                    raise ValueError('Unbalanced %s in puzzle JSON' % token)
+                if depth == 3 and key in ('rows', 'columns'):
+                    puzzle[key].end_line()
+                elif depth == 1:
+                    yield puzzle
+                    puzzle = None
+            elif depth == 0:
+                raise ValueError('Expected a puzzle object, got %s' % token)
+            elif token == ',':
+                expect_key = depth == 1
+            elif token == ':':
+                pass
+            elif depth == 1 and expect_key:
+                key = json.loads(token)
+                expect_key = False
+            elif depth == 1:
+                puzzle[key] = json.loads(token)
+            elif depth == 3 and key in ('rows', 'columns'):
+                puzzle[key].values.append(int(token))
+    if nesting:
+        raise ValueError('Unexpected end of puzzle JSON')
+
+
+# Shared flag set by Solver.guess_in_parallel once it has all the solutions
+# it needs; installed in every worker of its pool by set_branch_stop
+branch_stop = None
+
+
+def set_branch_stop(stop):
+    global branch_stop
+    branch_stop = stop
+
+
+def solve_branch(task):
+    # Worker side of Solver.guess_in_parallel
+    (
+        rows,
+        columns,
+        table,
+        engine,
+        line_engine,
+        probe_budget,
+        learn_nogoods,
+        max_nogoods,
+        instrument,
+        max_solutions
+    ) = task
+    solver = Solver(
+        rows=rows,
+        columns=columns,
+        engine=engine,
+        line_engine=line_engine,
+        headless=True,
+        probe_budget=probe_budget,
+        learn_nogoods=learn_nogoods,
+        max_nogoods=max_nogoods,
+        instrumentation=Instrumentation() if instrument else None,
+        should_stop=lambda: branch_stop is not None and branch_stop.value
+    )
+    solver.table = table
+    result = solver.solve(max_solutions)
+    tables = []
+    for grid in result.solutions:
+        solved = Grid(len(rows), len(columns))
+        for x, row in enumerate(grid):
+            for y, value in enumerate(row):
+                solved.set(x, y, 2 if value else 1)
+        tables.append(solved)
+    return tables, result.stats, solver.instrumentation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Solve a nonogram.')
+    parser.add_argument(
+        'puzzle', nargs='?', default='-',
+        help='puzzle file in JSON or row/column string form, - for stdin'
+    )
+    parser.add_argument(
+        '--format', choices=['json', 'text'], default='json',
+        help='output format of the solution grid'
+    )
+    parser.add_argument(
+        '--engine', choices=['python', 'numpy'], default='python'
+    )
+    parser.add_argument(
+        '--line-engine', choices=['auto'] + list(LINE_ENGINES),
+        default='auto', help='full line solver, the automaton by default'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='processes used to explore guessed branches in parallel'
+    )
+    parser.add_argument(
+        '--max-solutions', type=int, default=1,
+        help='stop after this many solutions, 2 checks uniqueness'
+    )
+    parser.add_argument(
+        '--instrument', action='store_true',
+        help='include detailed timers and counters in the stats'
+    )
+    parser.add_argument(
+        '--cache', help='SQLite file of cached solutions to read and update'
+    )
+    parser.add_argument(
+        '--example', nargs='?', const='large-100x100',
+        help='solve a puzzle from the bundled corpus by id instead of '
+             'reading input'
+    )
+    args = parser.parse_args(argv)
+
+    if args.example:
+        puzzles = [p for p in load_corpus() if p['id'] == args.example]
+        if not puzzles:
+            parser.error('no puzzle with id %s in the corpus' % args.example)
+        puzzle = puzzles[0]
+    else:
+        stream = sys.stdin if args.puzzle == '-' else open(args.puzzle)
+        try:
+            puzzle = next(iter_puzzles(stream), None)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if puzzle is None:
+            parser.error('no puzzle in the input')
+
+    options = dict(
+        engine=args.engine,
+        line_engine=args.line_engine,
+        workers=args.workers,
+        instrumentation=Instrumentation() if args.instrument else None
+    )
+    if args.cache:
+        # A hit never builds a Solver
+        cache = SolutionCache(args.cache)
+        try:
+            result = cache.solve(
+                puzzle['rows'], puzzle['columns'], args.max_solutions,
+                **options
+            )
+        finally:
+            cache.close()
+    else:
+        solver = Solver(input_json=puzzle, headless=True, **options)
+        result = solver.solve(args.max_solutions)
+
+    if args.format == 'json':
+        print(json.dumps(result.to_dict()))
+    elif result.grid is not None:
+        for row in result.grid:
+            print(''.join('#' if c else '.' for c in row))
+    else:
+        print(result.status)
+
+    return 0 if result.grid is not None else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count
+
+from batch import solve_puzzle, start_pool
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def request_error(puzzle, engine, max_solutions, timeout):
+    # Why a request can't be solved, or None; checked before a job is made
+    # so a bad request is answered instead of failing inside the pool
+    for name in ('rows', 'columns'):
+        clues = puzzle[name]
+        if not isinstance(clues, list) or not all(
+            isinstance(clue, list) and all(
+                is_count(block) and block >= 0 for block in clue
+            )
+            for clue in clues
+        ):
+            return 'Expected %s as lists of non-negative integers' % name
+    if engine not in ('python', 'numpy'):
+        return 'Unknown engine %s' % engine
+    if not is_count(max_solutions) or max_solutions < 1:
+        return 'Expected max_solutions as a positive integer'
+    if (
+        not isinstance(timeout, (int, float))
+        or isinstance(timeout, bool)
+        or not math.isfinite(timeout)
+        or timeout <= 0
+    ):
+        return 'Expected timeout as a positive number of seconds'
+    return None
+
+
+class Job:
+    # One solve in the pool, shared by every concurrent request for the
+    # same puzzle. waiters counts the requests still interested in it.
+    def __init__(self, key, puzzle, engine, max_solutions, deadline):
+        self.key = key
+        self.puzzle = puzzle
+        self.engine = engine
+        self.max_solutions = max_solutions
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.started = False
+        self.abandoned = False
+        self.slot = None
+
+
+class SolveService:
+    # Solves puzzles on a process pool from inside an event loop. Queued
+    # jobs are dispatched smallest puzzle first, so a burst of large puzzles
+    # can't hold up quick ones, and the per request timeout bounds how long
+    # a hard one can keep a worker busy. When max_queue jobs are waiting,
+    # new requests are turned away as busy instead of piling up.
+    def __init__(
+        self,
+        workers=None,
+        max_queue=100,
+        timeout=60,
+        memory_limit=None,
+        engine='python',
+        cache=None
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.engine = engine
+        self.cache = cache
+
+        self.jobs = {}
+        self.queue = []
+        self.queue_counter = count()
+        self.ready = None
+        self.executor = None
+        self.dispatchers = []
+        # One stop flag per dispatcher, set to stop the job it is running
+        self.stop_flags = None
+
+        self.queued = 0
+        self.running = 0
+        self.counters = {
+            'requests': 0,
+            'deduplicated': 0,
+            'solves': 0,
+            'rejected': 0,
+            'cancelled': 0,
+            'stopped': 0,
+            'timeouts': 0,
+        }
+        self.max_queued = 0
+
+    async def start(self):
+        self.ready = asyncio.Condition()
+        self.stop_flags = multiprocessing.RawArray('b', self.workers)
+        self.executor = start_pool(
+            self.workers, self.memory_limit, self.stop_flags
+        )
+        self.dispatchers = [
+            asyncio.create_task(self.dispatch(slot))
+            for slot in range(self.workers)
+        ]
+
+    async def close(self):
+        for task in self.dispatchers:
+            task.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.executor.shutdown(cancel_futures=True)
+
+    def metrics(self):
+        metrics = dict(self.counters)
+        metrics['queued'] = self.queued
+        metrics['max_queued'] = self.max_queued
+        metrics['running'] = self.running
+        metrics['workers'] = self.workers
+        return metrics
+
+    async def solve(self, request):
+        # Returns the result dict for one request; waits for an identical
+        # job already queued or running instead of solving it twice
+        self.counters['requests'] += 1
+        try:
+            puzzle = {'rows': request['rows'], 'columns': request['columns']}
+        except (KeyError, TypeError):
+            return {'status': 'error', 'error': 'Expected rows and columns'}
+        engine = request.get('engine', self.engine)
+        max_solutions = request.get('max_solutions', 1)
+        timeout = request.get('timeout', self.timeout)
+        error = request_error(puzzle, engine, max_solutions, timeout)
+        if error is not None:
+            return {'status': 'error', 'error': error}
+        deadline = time.monotonic() + timeout
+
+        key = json.dumps([puzzle, engine, max_solutions], sort_keys=True)
+        job = self.jobs.get(key)
+        if job is not None:
+            self.counters['deduplicated'] += 1
+            if not job.started:
+                job.deadline = max(job.deadline, deadline)
+        else:
+            if self.queued >= self.max_queue:
+                self.counters['rejected'] += 1
+                return {'status': 'busy', 'error': 'Too many queued puzzles'}
+            job = Job(key, puzzle, engine, max_solutions, deadline)
+            await self.enqueue(job)
+            self.jobs[key] = job
+
+        job.waiters += 1
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(job.future), deadline - time.monotonic()
+            )
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            return {'status': 'timeout', 'grid': None}
+        finally:
+            job.waiters -= 1
+            if not job.waiters and not job.future.done():
+                self.abandon(job)
+        return dict(result)
+
+    async def enqueue(self, job):
+        size = len(job.puzzle['rows']) * len(job.puzzle['columns'])
+        heapq.heappush(self.queue, (size, next(self.queue_counter), job))
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        async with self.ready:
+            self.ready.notify()
+
+    def abandon(self, job):
+        # Nobody waits for the job any more. A queued job is dropped when it
+        # is dequeued; a running one is told to stop, which its search does
+        # at the next node, freeing the worker for the next job.
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        if job.abandoned:
+            return
+        job.abandoned = True
+        if job.started:
+            self.stop_flags[job.slot] = 1
+            self.counters['stopped'] += 1
+        else:
+            self.queued -= 1
+
+    async def dispatch(self, slot):
+        while True:
+            async with self.ready:
+                await self.ready.wait_for(lambda: self.queue)
+                _, _, job = heapq.heappop(self.queue)
+            if job.abandoned:
+                continue
+            self.queued -= 1
+
+            remaining = job.deadline - time.monotonic()
+            if remaining <= 0:
+                self.finish(job, {'status': 'timeout', 'grid': None})
+                continue
+
+            job.started = True
+            job.slot = slot
+            self.stop_flags[slot] = 0
+            self.running += 1
+            self.counters['solves'] += 1
+            try:
+                result = await self.run(job)
+                del result['index']
+                del result['id']
+            except Exception as e:
+                result = {'status': 'error', 'grid': None, 'error': repr(e)}
+            finally:
+                self.running -= 1
+            self.finish(job, result)
+
+    async def run(self, job):
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(
+                executor, solve_puzzle, *self.solve_args(job)
+            )
+        except BrokenProcessPool:
+            pass
+
+        # A worker died (e.g. killed by the OS for running out of memory)
+        # and failed every job running on the pool with it. The first job
+        # to notice replaces the pool, and each job is rerun in a process of
+        # its own so only the one that kills its worker again fails.
+        if self.executor is executor:
+            self.executor = start_pool(
+                self.workers, self.memory_limit, self.stop_flags
+            )
+            executor.shutdown(wait=False, cancel_futures=True)
+        isolated = start_pool(1, self.memory_limit, self.stop_flags)
+        try:
+            return await loop.run_in_executor(
+                isolated, solve_puzzle, *self.solve_args(job)
+            )
+        finally:
+            isolated.shutdown(wait=False)
+
+    def solve_args(self, job):
+        return (
+            0,
+            job.puzzle,
+            max(job.deadline - time.monotonic(), 0.001),
+            job.engine,
+            job.max_solutions,
+            self.cache,
+            job.slot
+        )
+
+    def finish(self, job, result):
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        if not job.future.done():
+            job.future.set_result(result)
+
+    async def handle_connection(self, reader, writer):
+        # Line delimited JSON. Each request line is a puzzle in the
+        # input_json shape plus an optional id, timeout, engine and
+        # max_solutions; {"cancel": id} cancels a pending request and
+        # {"metrics": true} reports the queue state. Responses carry the
+        # request id and are written as they complete. Requests without an
+        # id are tracked under a key of their own and can't be cancelled.
+        tasks = {}
+        unnamed = count()
+        responses = asyncio.Queue()
+
+        async def write_responses():
+            while True:
+                response = await responses.get()
+                if response is None:
+                    break
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+        def done(key, request_id, task):
+            # Also called for a request cancelled before it started running
+            tasks.pop(key, None)
+            if task.cancelled():
+                self.counters['cancelled'] += 1
+                response = {'status': 'cancelled', 'grid': None}
+            elif task.exception() is not None:
+                response = {
+                    'status': 'error',
+                    'grid': None,
+                    'error': repr(task.exception()),
+                }
+            else:
+                response = task.result()
+            response['id'] = request_id
+            responses.put_nowait(response)
+
+        writing = asyncio.create_task(write_responses())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    responses.put_nowait(
+                        {'status': 'error', 'error': 'Invalid JSON'}
+                    )
+                    continue
+                if not isinstance(request, dict):
+                    responses.put_nowait(
+                        {'status': 'error', 'error': 'Expected an object'}
+                    )
+                    continue
+
+                request_id = request.get('id')
+                if not is_scalar(request_id) or not is_scalar(
+                    request.get('cancel')
+                ):
+                    responses.put_nowait({
+                        'id': request_id,
+                        'status': 'error',
+                        'error': 'Expected ids as strings or numbers',
+                    })
+                elif request.get('metrics'):
+                    responses.put_nowait(
+                        {'id': request_id, 'metrics': self.metrics()}
+                    )
+                elif 'cancel' in request:
+                    task = tasks.get(request['cancel'])
+                    if task is not None:
+                        task.cancel()
+                elif request_id is not None and request_id in tasks:
+                    responses.put_nowait({
+                        'id': request_id,
+                        'status': 'error',
+                        'error': 'Duplicate request id',
+                    })
+                else:
+                    # Ids are JSON scalars, so no id can equal a tuple key
+                    key = request_id
+                    if key is None:
+                        key = ('unnamed', next(unnamed))
+                    task = asyncio.create_task(self.solve(request))
+                    tasks[key] = task
+                    task.add_done_callback(
+                        lambda task, key=key, request_id=request_id:
+                            done(key, request_id, task)
+                    )
+        finally:
+            # The client went away, nobody is left to read the answers
+            for task in list(tasks.values()):
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            responses.put_nowait(None)
+            try:
+                await writing
+            except ConnectionError:
+                pass
+            writer.close()
+
+
+async def serve(host, port, **options):
+    service = SolveService(**options)
+    await service.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve puzzle solving over line delimited JSON on TCP.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument(
+        '--max-queue', type=int, default=100,
+        help='queued puzzles before new requests are rejected as busy'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=60,
+        help='default seconds allowed per request'
+    )
+    parser.add_argument(
+        '--memory-limit', type=int, default=None,
+        help='address space limit per worker in megabytes'
+    )
+    parser.add_argument(
+        '--engine', choices=['python', 'numpy'], default='python'
+    )
+    parser.add_argument(
+        '--cache', help='SQLite file of cached solutions shared by the workers'
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(
+            args.host,
+            args.port,
+            workers=args.workers,
+            max_queue=args.max_queue,
+            timeout=args.timeout,
+            memory_limit=args.memory_limit,
+            engine=args.engine,
+            cache=args.cache
+        ))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())